@@ -27,5 +27,6 @@ setup(
         'pytz',
         'mutagen',
         'pillow',
+        'scandir',
     ),
 )
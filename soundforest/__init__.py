@@ -7,10 +7,14 @@ Audio file tree processing classes
 
 import os
 import sys
+import time
 import unicodedata
 
 from soundforest.defaults import SOUNDFOREST_USER_DIR
 
+# Seconds between checks for modified PATH directories in CommandPathCache
+PATH_CHECK_INTERVAL = 5
+
 
 class SoundforestError(Exception):
     pass
@@ -28,6 +32,7 @@ def normalized(path, normalization='NFC'):
     if sys.platform != 'darwin':
         if not isinstance(path, unicode):
             return unicode(path, 'utf-8')
+        return path
 
     if not isinstance(path, unicode):
         path = unicode(path, 'utf-8')
@@ -35,46 +40,77 @@ def normalized(path, normalization='NFC'):
     return unicodedata.normalize(normalization, path)
 
 
-class CommandPathCache(list):
+class CommandPathCache(object):
 
     """
     Class to represent commands on user's search path.
+
+    Commands are looked up from PATH directories on demand and lookups
+    are cached, including misses. Cached lookups are dropped when PATH or
+    mtime of any PATH directory changes, checked at most once in
+    PATH_CHECK_INTERVAL seconds.
     """
     def __init__(self):
-        list.__init__(self)
         self.paths = None
-        self.update()
+        self.search_path = None
+        self.commands = {}
+        self.mtimes = {}
+        self.checked = None
+
+    def __directory_mtimes__(self):
+        mtimes = {}
+        for path in self.paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def __check_modified__(self):
+        """
+        Clear cached lookups if PATH or PATH directories have been modified
+        """
+        now = time.time()
+        if self.checked is not None and now - self.checked < PATH_CHECK_INTERVAL:
+            return
+
+        if self.search_path != os.getenv('PATH', '') or self.mtimes != self.__directory_mtimes__():
+            self.update()
+        self.checked = now
 
     def update(self):
         """
-        Updates the commands available on user's PATH
+        Reads directories on user's PATH and clears cached lookups
         """
+        self.search_path = os.getenv('PATH', '')
         self.paths = []
-        self.__delslice__(0, len(self))
-
-        for path in os.getenv('PATH').split(os.pathsep):
-            if not self.paths.count(path):
+        for path in self.search_path.split(os.pathsep):
+            if path and not self.paths.count(path):
                 self.paths.append(path)
 
-        for path in self.paths:
-            if not os.path.isdir(path):
-                continue
-
-            for cmd in [os.path.join(path, f) for f in os.listdir(path)]:
-                if os.path.isdir(cmd) or not os.access(cmd, os.X_OK):
-                    continue
-
-                self.append(cmd)
+        self.commands = {}
+        self.mtimes = self.__directory_mtimes__()
+        self.checked = time.time()
 
     def versions(self, name):
         """
         Returns all commands with given name on path, ordered by PATH search
-        order.
+        order. PATH is read on first call.
         """
-        if not len(self):
+        if self.paths is None:
             self.update()
+        else:
+            self.__check_modified__()
+
+        if name not in self.commands:
+            commands = []
+            for path in self.paths:
+                cmd = os.path.join(path, name)
+                if os.path.isfile(cmd) and os.access(cmd, os.X_OK):
+                    commands.append(cmd)
+            self.commands[name] = commands
 
-        return [cmd for cmd in self if os.path.basename(cmd) == name]
+        return list(self.commands[name])
 
     def which(self, name):
         """
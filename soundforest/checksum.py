@@ -0,0 +1,281 @@
+# coding=utf-8
+"""File checksums
+
+Streaming checksum calculation for audio files with selectable hash algorithm.
+
+Checksums are calculated either over the whole file, or in 'audio' mode only
+over the audio data, skipping the tag blocks of the file. Audio checksums do
+not change when tags are edited.
+
+"""
+
+import os
+import struct
+import hashlib
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+from soundforest import SoundforestError
+
+DEFAULT_CHECKSUM_ALGORITHM = 'md5'
+CHECKSUM_CHUNK_SIZE = 2**20
+
+CHECKSUM_ALGORITHMS = (
+    'md5',
+    'sha1',
+    'sha256',
+    'blake2b',
+)
+
+DEFAULT_CHECKSUM_MODE = 'file'
+CHECKSUM_MODES = (
+    'file',
+    'audio',
+)
+
+
+class ChecksumError(SoundforestError):
+    pass
+
+
+def available_algorithms():
+    """Return checksum algorithms supported by this python installation"""
+    return [name for name in CHECKSUM_ALGORITHMS if name != 'blake2b' or blake2b is not None]
+
+
+def new_hash(algorithm=DEFAULT_CHECKSUM_ALGORITHM):
+    """Return new hash object for algorithm
+
+    Raises ChecksumError for unknown or unavailable algorithms.
+
+    """
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ChecksumError('Unknown checksum algorithm: %s' % algorithm)
+
+    if algorithm == 'blake2b':
+        if blake2b is None:
+            raise ChecksumError('blake2b requires python 3.6 or pyblake2 module')
+        return blake2b()
+
+    return hashlib.new(algorithm)
+
+
+def update_hash(checksum, fd, offset=0, length=None, chunk_size=CHECKSUM_CHUNK_SIZE):
+    """Update hash with file contents from offset
+
+    Reads length bytes, or until end of file if length is None, in chunks
+    of chunk_size bytes.
+
+    """
+    fd.seek(offset)
+    while length is None or length > 0:
+        if length is not None:
+            chunk = fd.read(min(chunk_size, length))
+            length -= len(chunk)
+        else:
+            chunk = fd.read(chunk_size)
+
+        if not chunk:
+            break
+        checksum.update(chunk)
+
+
+def file_checksum(path, algorithm=DEFAULT_CHECKSUM_ALGORITHM, chunk_size=CHECKSUM_CHUNK_SIZE):
+    """Return hex digest of file contents
+
+    File is read in chunks of chunk_size bytes, so memory usage does not
+    depend on file size.
+
+    """
+    checksum = new_hash(algorithm)
+    with open(path, 'rb') as fd:
+        update_hash(checksum, fd, chunk_size=chunk_size)
+    return checksum.hexdigest()
+
+
+def id3v2_size(fd, offset=0):
+    """Return size of ID3v2 tag at offset, 0 if there is no tag"""
+    fd.seek(offset)
+    header = fd.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+
+    flags = struct.unpack('>B', header[5:6])[0]
+    size = 0
+    for byte in struct.unpack('>4B', header[6:10]):
+        size = (size << 7) | (byte & 0x7f)
+
+    # Tag header and optional footer
+    size += 10
+    if flags & 0x10:
+        size += 10
+
+    return size
+
+
+def skip_id3v2(fd):
+    """Return offset after all ID3v2 tags in start of file"""
+    offset = 0
+    while True:
+        size = id3v2_size(fd, offset)
+        if not size:
+            return offset
+        offset += size
+
+
+def mp3_audio_ranges(fd, size):
+    """Return audio data range of mp3 file
+
+    Skips ID3v2 tags in start of file and APEv2 and ID3v1 tags in end of file
+
+    """
+    start = skip_id3v2(fd)
+    end = size
+
+    if end - start >= 128:
+        fd.seek(end - 128)
+        if fd.read(3) == b'TAG':
+            end -= 128
+
+    if end - start >= 32:
+        fd.seek(end - 32)
+        footer = fd.read(32)
+        if footer[:8] == b'APETAGEX':
+            tag_size, flags = struct.unpack('<I4xI', footer[12:24])
+            end -= tag_size
+            if flags & 0x80000000:
+                end -= 32
+
+    if end <= start:
+        raise ChecksumError('No audio data in mp3 file')
+
+    return [(start, end - start)]
+
+
+def flac_audio_ranges(fd, size):
+    """Return audio data range of flac file
+
+    Skips the metadata blocks (tags, pictures, padding etc.) after the fLaC
+    marker, and ID3v2 tags some programs prepend to flac files
+
+    """
+    offset = skip_id3v2(fd)
+    fd.seek(offset)
+    if fd.read(4) != b'fLaC':
+        raise ChecksumError('Not a flac file')
+    offset += 4
+
+    while True:
+        fd.seek(offset)
+        header = fd.read(4)
+        if len(header) < 4:
+            raise ChecksumError('Truncated flac metadata block')
+
+        value = struct.unpack('>I', header)[0]
+        flags, length = value >> 24, value & 0xffffff
+        offset += 4 + length
+        if flags & 0x80:
+            break
+
+    if offset >= size:
+        raise ChecksumError('No audio data in flac file')
+
+    return [(offset, size - offset)]
+
+
+def mp4_audio_ranges(fd, size):
+    """Return mdat atom data ranges of MPEG-4 audio file
+
+    Only the mdat atoms are hashed: the moov atom contains chunk offset
+    tables which change when udta tags before the audio data are resized.
+
+    """
+    ranges = []
+    offset = 0
+    while offset + 8 <= size:
+        fd.seek(offset)
+        atom_size, name = struct.unpack('>I4s', fd.read(8))
+        header_size = 8
+        if atom_size == 1:
+            atom_size = struct.unpack('>Q', fd.read(8))[0]
+            header_size = 16
+        elif atom_size == 0:
+            atom_size = size - offset
+
+        if atom_size < header_size:
+            raise ChecksumError('Invalid MPEG-4 atom size at offset %d' % offset)
+
+        if name == b'mdat':
+            ranges.append((offset + header_size, atom_size - header_size))
+
+        offset += atom_size
+
+    if not ranges:
+        raise ChecksumError('No mdat atom in MPEG-4 file')
+
+    return ranges
+
+
+AUDIO_RANGE_PARSERS = {
+    'mp3':  mp3_audio_ranges,
+    'flac': flac_audio_ranges,
+    'm4a':  mp4_audio_ranges,
+    'm4r':  mp4_audio_ranges,
+    'alac': mp4_audio_ranges,
+}
+
+
+def stored_checksum_type(algorithm, mode):
+    """Return algorithm and mode of checksum stored to database
+
+    Checksums were md5 over whole file before algorithm and mode were
+    recorded: missing values default to these.
+
+    """
+    return algorithm or u'md5', mode or u'file'
+
+
+def effective_checksum_mode(mode, codec_name):
+    """Return checksum mode used for codec
+
+    Audio checksums fall back to 'file' mode for codecs without parser
+    for audio data ranges.
+
+    """
+    if mode not in CHECKSUM_MODES:
+        raise ChecksumError('Unknown checksum mode: %s' % mode)
+
+    if mode == 'audio' and codec_name not in AUDIO_RANGE_PARSERS:
+        return 'file'
+
+    return mode
+
+
+def track_checksum(path, codec_name=None, algorithm=DEFAULT_CHECKSUM_ALGORITHM,
+                   mode=DEFAULT_CHECKSUM_MODE, chunk_size=CHECKSUM_CHUNK_SIZE):
+    """Return hex digest of audio file with given checksum mode
+
+    Raises ChecksumError if audio data can't be located in the file.
+
+    """
+    if effective_checksum_mode(mode, codec_name) == 'file':
+        return file_checksum(path, algorithm, chunk_size)
+
+    checksum = new_hash(algorithm)
+    with open(path, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        try:
+            ranges = AUDIO_RANGE_PARSERS[codec_name](fd, size)
+        except struct.error:
+            raise ChecksumError('Error parsing %s file: %s' % (codec_name, path))
+
+        for offset, length in ranges:
+            update_hash(checksum, fd, offset, length, chunk_size)
+
+    return checksum.hexdigest()
@@ -7,10 +7,12 @@ classes in soundforest.models for cli scripts.
 """
 
 import os
-import hashlib
 
 from soundforest import models, TreeError, SoundforestError
 from soundforest.log import SoundforestLogger
+from soundforest.checksum import track_checksum, effective_checksum_mode, ChecksumError
+from soundforest.checksum import DEFAULT_CHECKSUM_ALGORITHM, DEFAULT_CHECKSUM_MODE
+from soundforest.updater import TreeUpdater
 from soundforest.defaults import DEFAULT_CODECS, DEFAULT_TREE_TYPES
 
 FIELD_CONVERT_MAP = {
@@ -22,16 +24,24 @@ class ConfigDB(object):
 
     Configuration database settings API
 
+    The database is opened on first attribute access, so creating ConfigDB
+    objects at import time is cheap.
+
     """
 
     __db_instance = None
+    __db_path = None
     def __init__(self, path=None):
+        if not ConfigDB.__db_instance and path is not None:
+            ConfigDB.__db_path = path
+
+    def __get_instance__(self):
         if not ConfigDB.__db_instance:
-            ConfigDB.__db_instance = ConfigDB.ConfigInstance(path)
-        self.__dict__['ConfigDB.__db_instance'] = ConfigDB.__db_instance
+            ConfigDB.__db_instance = ConfigDB.ConfigInstance(ConfigDB.__db_path)
+        return ConfigDB.__db_instance
 
     def __getattr__(self, attr):
-        return getattr(self.__db_instance, attr)
+        return getattr(self.__get_instance__(), attr)
 
     class ConfigInstance(models.SoundforestDB):
         """Configuration database instance
@@ -53,8 +63,22 @@ class ConfigDB(object):
                 self.add(treetypes)
                 self.commit()
 
-            self.codecs = CodecConfiguration(db=self)
-            self.sync = SyncConfiguration(db=self)
+            self.__codecs = None
+            self.__sync = None
+
+        @property
+        def codecs(self):
+            """Codec configuration, loaded on first use"""
+            if self.__codecs is None:
+                self.__codecs = CodecConfiguration(db=self)
+            return self.__codecs
+
+        @property
+        def sync(self):
+            """Sync target configuration, loaded on first use"""
+            if self.__sync is None:
+                self.__sync = SyncConfiguration(db=self)
+            return self.__sync
 
         def get(self, key):
             entry = self.session.query(models.SettingModel).filter(models.SettingModel.key==key).first()
@@ -101,106 +125,51 @@ class ConfigDB(object):
             return [s.value for s in self.session.query(models.SettingModel).all()]
 
 
-    def update_tree(self, tree, update_checksum=True, progresslog=False):
+    def update_tree(self, tree, update_checksum=True, progresslog=False, incremental=False, albums=None):
         """
         Update tracks in database from loaded tree instance
-        """
-        added, updated, deleted, errors = 0, 0, 0, 0
-
-        db_tree = self.get_tree(tree.path)
-        albums = tree.as_albums()
-        album_paths = [a.path for a in albums]
-        track_paths = tree.realpaths
-
-        self.log.debug('Updating existing tree tracks')
-        processed = 0
-
-        for album in albums:
-
-            db_album = self.query(models.AlbumModel).filter(
-                models.AlbumModel.tree == db_tree,
-                models.AlbumModel.directory == album.path
-            ).first()
-
-            if db_album is None:
-                db_album = models.AlbumModel(
-                    tree=db_tree,
-                    directory=album.path,
-                    mtime=album.mtime
-                )
-                self.add(db_album)
-
-            elif db_album.mtime != album.mtime:
-                db_album.mtime = album.mtime
-
-            for track in album:
-                db_track = self.query(models.TrackModel).filter(
-                    models.TrackModel.directory == track.path.directory,
-                    models.TrackModel.filename == track.path.filename
-                ).first()
-
-                if db_track is None:
-                    db_track = models.TrackModel(
-                        tree=db_tree,
-                        album=db_album,
-                        directory=track.directory,
-                        filename=track.filename,
-                        extension=track.extension,
-                        mtime=track.mtime,
-                        deleted=False,
-                    )
-                    if self.update_track(track):
-                        added +=1
-                    else:
-                        errors +=1
-
-                elif db_track.mtime != track.mtime:
-                    if self.update_track(track):
-                        updated += 1
-                    else:
-                        errors +=1
-
-                elif not db_track.checksum and update_checksum:
-                    if self.update_track_checksum(track):
-                        updated += 1
-                    else:
-                        errors +=1
-
-                processed += 1
-                if progresslog and processed % 1000 == 0:
-                    self.log.debug('Processed: %d tracks' % processed)
-
-            self.commit()
-
-        self.log.debug('Checking for removed albums')
-        for album in db_tree.albums:
-            if album.path in album_paths or album.exists:
-                continue
 
-            self.log.debug('Removing album: %s' % album.path)
-            self.delete(album)
+        Changes are written in batches by soundforest.updater.TreeUpdater,
+        reading tags with number of worker processes given in 'threads'
+        setting.
 
-        self.log.debug('Checking for removed tracks')
-        for track in db_tree.tracks:
-            if track.path in track_paths or track.exists:
-                continue
+        With incremental set, albums whose directory mtime matches the mtime
+        recorded in database by previous update are skipped without checking
+        their tracks. Directory mtime only changes when files are added,
+        removed or renamed: files modified in place are not detected.
 
-            self.log.debug('Removing track: %s' % track.path)
-            self.delete(track)
-            deleted += 1
+        With albums, only given Album objects of the tree are updated and
+        checked for removed tracks, without loading the whole tree.
 
-        self.commit()
+        Albums and tracks missing from the scanned tree are deleted in bulk
+        by TreeUpdater.delete_missing.
+
+        Returns counters for added, updated, deleted, processed and error
+        tracks, followed by number of deleted albums.
+        """
+        updater = TreeUpdater(self, tree)
+        added, updated, processed, errors = updater.update(
+            update_checksum=update_checksum,
+            progresslog=progresslog,
+            incremental=incremental,
+            albums=albums
+        )
+
+        self.log.debug('Checking for removed albums and tracks')
+        deleted_albums, deleted = updater.delete_missing()
+        if deleted_albums or deleted:
+            self.log.debug('Removed %d albums and %d tracks' % (deleted_albums, deleted))
 
         if errors > 0:
             self.log.debug('Total %d errors updating tree' % errors)
 
-        return added, updated, deleted, processed, errors
+        return added, updated, deleted, processed, errors, deleted_albums
 
     def update_track(self, track, update_checksum=True):
         db_track = self.get_track(track.path)
         db_track.mtime = track.mtime
 
-        oldtags = self.query(models.TrackModel).filter(models.TagModel.track == db_track)
+        oldtags = self.query(models.TagModel).filter(models.TagModel.track == db_track)
         for tag in oldtags:
             self.delete(tag)
 
@@ -210,8 +179,18 @@ class ConfigDB(object):
             self.log.debug('ERROR loading %s: %s' % (track.path, emsg))
             return False
 
-        for tag, value in tags.items():
-            self.add(models.TagModel(track=db_track, tag=tag, value=value))
+        values = []
+        for tag, tag_values in tags.items():
+            if not isinstance(tag_values, list):
+                tag_values = [tag_values]
+            for value in tag_values:
+                self.session.add(models.new_tag(self.session, db_track, tag, value))
+                values.append((tag, value))
+        db_track.tag_document = models.tag_document(values)
+
+        self.update_search_index([models.search_index_entry(
+            db_track.id, db_track.tree, db_track.path, [value for tag, value in values]
+        )])
         self.commit()
 
         if update_checksum:
@@ -221,12 +200,17 @@ class ConfigDB(object):
         return True
 
     def update_track_checksum(self, track):
+        algorithm = self.get('checksum_algorithm') or DEFAULT_CHECKSUM_ALGORITHM
+        mode = effective_checksum_mode(self.get('checksum_mode') or DEFAULT_CHECKSUM_MODE, track.codec.name)
         db_track = self.get_track(track.path)
-        with open(track.path, 'rb') as fd:
-            m = hashlib.md5()
-            m.update(fd.read())
-            db_track.checksum = m.hexdigest()
-            self.commit()
+        try:
+            db_track.checksum = track_checksum(track.path, track.codec.name, algorithm, mode)
+        except ChecksumError, emsg:
+            self.log.debug('ERROR calculating checksum for %s: %s' % (track.path, emsg))
+            return False
+        db_track.checksum_algorithm = algorithm
+        db_track.checksum_mode = mode
+        self.commit()
 
         return True
 
@@ -266,7 +250,11 @@ class SyncConfiguration(ConfigDBDictionary):
 
     @property
     def threads(self):
-        return int(self.db.get('threads'))
+        """Number of parallel worker processes, 1 if not configured"""
+        try:
+            return max(1, int(self.db.get('threads')))
+        except (TypeError, ValueError):
+            return 1
 
     @property
     def default_targets(self):
@@ -300,10 +288,30 @@ class CodecConfiguration(ConfigDBDictionary):
             codec = self.db.register_codec(name, **settings)
             self[str(codec.name)] = codec
 
+        self.update_extension_map()
+
+    def update_extension_map(self):
+        """Build extension lookup map
+
+        Maps lowercase extensions and codec names to codecs, so matching
+        paths to codecs does not load extensions from database. Codec names
+        have precedence over extensions of other codecs.
+
+        """
+        self.extension_map = {}
+        self.codec_extensions = {}
+
+        for name, codec in self.items():
+            extensions = [e.extension for e in codec.extensions]
+            self.codec_extensions[name] = [name] + extensions
+            for ext in extensions:
+                self.extension_map.setdefault(ext.lower(), codec)
+
+        for name, codec in self.items():
+            self.extension_map[name.lower()] = codec
+
     def extensions(self, codec):
-        if codec in self.keys():
-            return [codec] + [e.extension for e in self[codec].extensions]
-        return []
+        return list(self.codec_extensions.get(codec, []))
 
     def match(self, path):
         ext = os.path.splitext(path)[1][1:]
@@ -311,11 +319,4 @@ class CodecConfiguration(ConfigDBDictionary):
         if ext == '':
             ext = path
 
-        if ext in self.keys():
-            return self[ext]
-
-        for codec in self.values():
-            if ext in [e.extension for e in codec.extensions]:
-                return codec
-
-        return None
+        return self.extension_map.get(ext.lower(), None)
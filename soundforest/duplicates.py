@@ -0,0 +1,179 @@
+# coding=utf-8
+"""Duplicate tracks
+
+Find tracks with identical content in all registered trees, using checksums
+and file sizes stored to database by tree updates.
+
+Tracks are grouped by checksum algorithm, mode and value. Tracks without a
+checksum of the configured algorithm and mode are only hashed if another
+track has the same file size: a file with unique size has no duplicates.
+
+With 'audio' checksum mode, copies of a track with different tags differ in
+size, and are only found if both tracks already have audio checksums.
+
+"""
+
+import os
+
+from itertools import imap
+from multiprocessing import Pool
+from sqlalchemy import select, bindparam, func
+
+from soundforest import models
+from soundforest.checksum import new_hash, effective_checksum_mode, stored_checksum_type
+from soundforest.checksum import DEFAULT_CHECKSUM_ALGORITHM, DEFAULT_CHECKSUM_MODE
+from soundforest.formats import match_codec
+from soundforest.log import SoundforestLogger
+from soundforest.updater import read_track_info, chunks, DEFAULT_BATCH_SIZE, WORKER_CHUNK_SIZE
+
+
+class DuplicateFinder(object):
+
+    """DuplicateFinder
+
+    Find duplicate tracks in registered trees by checksum. Missing file
+    sizes and checksums are calculated and stored to database first.
+
+    """
+
+    def __init__(self, db, batch_size=DEFAULT_BATCH_SIZE, workers=None):
+        self.log = SoundforestLogger().default_stream
+        self.db = db
+        self.batch_size = batch_size
+        self.workers = workers is not None and workers or db.sync.threads
+        self.checksum_algorithm = db.get('checksum_algorithm') or DEFAULT_CHECKSUM_ALGORITHM
+        self.checksum_mode = db.get('checksum_mode') or DEFAULT_CHECKSUM_MODE
+
+    def __update__(self, values, columns):
+        """Update track columns with executemany, committing once per batch"""
+        tracks = models.TrackModel.__table__
+        statement = tracks.update() \
+            .where(tracks.c.id == bindparam('track_id')) \
+            .values(dict((column, bindparam(column)) for column in columns))
+
+        for batch in chunks(values, self.batch_size):
+            self.db.session.execute(statement, batch)
+            self.db.commit()
+
+    def update_sizes(self):
+        """Store file sizes of tracks added before sizes were recorded
+
+        Tracks whose file can't be accessed are skipped. Returns number of
+        updated tracks.
+
+        """
+        tracks = models.TrackModel.__table__
+
+        sizes = []
+        for row in self.db.session.execute(
+                select([tracks.c.id, tracks.c.directory, tracks.c.filename])
+                .where(tracks.c.size == None)):
+            try:
+                size = os.stat(os.path.join(row.directory, row.filename)).st_size
+            except OSError:
+                continue
+            sizes.append({'track_id': row.id, 'size': size})
+
+        self.log.debug('Updating file size of %d tracks' % len(sizes))
+        self.__update__(sizes, ('size',))
+        return len(sizes)
+
+    def update_checksums(self):
+        """Calculate checksums for tracks sharing file size with another track
+
+        Tracks which already have a checksum with configured algorithm and
+        mode are not read. Returns number of updated tracks.
+
+        """
+        tracks = models.TrackModel.__table__
+
+        # Fail early for unknown or unavailable algorithms and modes
+        new_hash(self.checksum_algorithm)
+        effective_checksum_mode(self.checksum_mode, None)
+
+        shared_sizes = select([tracks.c.size]) \
+            .where(tracks.c.size != None) \
+            .group_by(tracks.c.size) \
+            .having(func.count(tracks.c.id) > 1)
+
+        queue = []
+        track_ids = []
+        for row in self.db.session.execute(
+                select([
+                    tracks.c.id, tracks.c.directory, tracks.c.filename,
+                    tracks.c.checksum, tracks.c.checksum_algorithm, tracks.c.checksum_mode
+                ])
+                .where(tracks.c.size.in_(shared_sizes))):
+            path = os.path.join(row.directory, row.filename)
+            codec = match_codec(path)
+            codec_name = codec is not None and codec.name or None
+            checksum_mode = effective_checksum_mode(self.checksum_mode, codec_name)
+
+            if row.checksum and \
+               stored_checksum_type(row.checksum_algorithm, row.checksum_mode) == \
+               (self.checksum_algorithm, checksum_mode):
+                continue
+
+            queue.append((len(queue), path, codec_name, False, self.checksum_algorithm, checksum_mode))
+            track_ids.append(row.id)
+
+        self.log.debug('Calculating checksums for %d tracks with %d workers' % (len(queue), self.workers))
+        if self.workers > 1 and len(queue) > 1:
+            pool = Pool(processes=self.workers)
+            results = pool.imap_unordered(read_track_info, queue, chunksize=WORKER_CHUNK_SIZE)
+        else:
+            pool = None
+            results = imap(read_track_info, queue)
+
+        checksums = []
+        try:
+            for info in results:
+                if info['error'] is not None:
+                    self.log.debug('ERROR loading %s: %s' % (info['path'], info['error']))
+                    continue
+
+                checksums.append({
+                    'track_id': track_ids[info['job']],
+                    'checksum': info['checksum'],
+                    'checksum_algorithm': self.checksum_algorithm,
+                    'checksum_mode': queue[info['job']][5],
+                })
+
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        self.__update__(checksums, ('checksum', 'checksum_algorithm', 'checksum_mode'))
+        return len(checksums)
+
+    def find(self, update=True):
+        """Return groups of duplicate tracks
+
+        With update, missing sizes and checksums are calculated first.
+        Returns lists of TrackModel objects sorted by path.
+
+        """
+        tracks = models.TrackModel.__table__
+
+        if update:
+            self.update_sizes()
+            self.update_checksums()
+
+        checksums = [row.checksum for row in self.db.session.execute(
+            select([tracks.c.checksum])
+            .where(tracks.c.checksum != None)
+            .group_by(tracks.c.checksum)
+            .having(func.count(tracks.c.id) > 1)
+        )]
+
+        groups = {}
+        for chunk in chunks(checksums):
+            for track in self.db.query(models.TrackModel).filter(models.TrackModel.checksum.in_(chunk)):
+                key = track.checksum_type + (track.checksum,)
+                groups.setdefault(key, []).append(track)
+
+        return sorted(
+            [sorted(group, key=lambda track: track.path) for group in groups.values() if len(group) > 1],
+            key=lambda group: group[0].path
+        )
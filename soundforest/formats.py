@@ -8,6 +8,7 @@ Guessing of supported file formats and codecs based on extensions
 import os
 import tempfile
 
+from stat import S_ISREG
 from subprocess import Popen, PIPE
 
 from soundforest import normalized, SoundforestError, CommandPathCache
@@ -15,22 +16,16 @@ from soundforest.config import ConfigDB
 from soundforest.defaults import SOUNDFOREST_CACHE_DIR
 from soundforest.log import SoundforestLogger
 from soundforest.metadata import Metadata
+from soundforest.tags.formats import get_tag_parser
 
 logger = SoundforestLogger().default_stream
 
-TAG_PARSERS = {
-    'm4a':      'soundforest.tags.formats.aac.aac',
-    'm4r':      'soundforest.tags.formats.aac.aac',
-    'mp3':      'soundforest.tags.formats.mp3.mp3',
-    'flac':     'soundforest.tags.formats.flac.flac',
-    'vorbis':   'soundforest.tags.formats.vorbis.vorbis',
-}
-
+# Both are initialized on first use
 PATH_CACHE = CommandPathCache()
-PATH_CACHE.update()
-
 db = ConfigDB()
 
+METADATA = Metadata()
+
 def filter_available_command_list(commands):
     available = []
     for cmd in commands:
@@ -46,23 +41,18 @@ def filter_available_command_list(commands):
     return available
 
 def match_codec(path):
-    ext = os.path.splitext(path)[1][1:]
-
-    if ext == '':
-        ext = path
+    return db.codecs.match(path)
 
-    if ext in db.codecs.keys():
-        return db.codecs[ext]
+def match_metadata(path, resolve=True):
+    """Match path to metadata file types
 
-    for codec in db.codecs.values():
-        if ext in [e.extension for e in codec.extensions]:
-            return codec
+    Symlinks are matched with target filename, unless resolve is False.
 
-    return None
+    """
+    if resolve:
+        path = os.path.realpath(path)
 
-def match_metadata(path):
-    metadata = Metadata()
-    m = metadata.match(path)
+    m = METADATA.match(path)
     if not m:
         return None
 
@@ -113,9 +103,10 @@ class AudioFileFormat(object):
 
     """
 
-    def __init__(self, path):
+    def __init__(self, path, stat=None):
         self.log =  SoundforestLogger().default_stream
         self.path = path_string(path)
+        self.stat_result = stat
         self.codec = None
         self.description = None
         self.is_metadata = False
@@ -151,23 +142,46 @@ class AudioFileFormat(object):
     def extension(self):
         return os.path.splitext(self.path)[1][1:]
 
+    def __stat__(self):
+        """Return stat of the file, or None if path is not a file
+
+        Stat is cached until refresh() is called.
+
+        """
+        if self.stat_result is None:
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return None
+            if not S_ISREG(stat.st_mode):
+                return None
+            self.stat_result = stat
+        return self.stat_result
+
+    def refresh(self):
+        """Drop cached stat of the file, for example after file was modified"""
+        self.stat_result = None
+
     @property
     def size(self):
-        if not self.path.isfile:
+        stat = self.__stat__()
+        if stat is None:
             return None
-        return os.stat(self.path).st_size
+        return stat.st_size
 
     @property
     def ctime(self):
-        if not self.path.isfile:
+        stat = self.__stat__()
+        if stat is None:
             return None
-        return os.stat(self.path).st_ctime
+        return stat.st_ctime
 
     @property
     def mtime(self):
-        if not self.path.isfile:
+        stat = self.__stat__()
+        if stat is None:
             return None
-        return os.stat(self.path).st_mtime
+        return stat.st_mtime
 
     def get_temporary_file(self, dir=SOUNDFOREST_CACHE_DIR, prefix='tmp', suffix=''):
         if not os.path.isdir(dir):
@@ -181,19 +195,10 @@ class AudioFileFormat(object):
         return tempfile.mktemp(dir=dir, prefix=prefix, suffix=suffix)
 
     def get_tag_parser(self):
-        if self.codec is None or self.codec.name not in TAG_PARSERS.keys():
-            return None
-
-        try:
-            classpath = TAG_PARSERS[self.codec.name]
-            module_path = '.'.join(classpath.split('.')[:-1])
-            class_name = classpath.split('.')[-1]
-            m = __import__(module_path, globals(), fromlist=[class_name])
-
-        except KeyError, emsg:
+        if self.codec is None:
             return None
 
-        return getattr(m, class_name)
+        return get_tag_parser(self.codec.name)
 
     def get_available_encoders(self):
         if self.codec is None or not self.codec.encoders:
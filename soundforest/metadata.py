@@ -55,8 +55,8 @@ class MetadataFileType(object):
         if you need more complicated logic.
 
         Returns true if the filename matches metadata type, False if not.
+        Symlinks are not resolved here: see soundforest.formats.match_metadata
         """
-        path = os.path.realpath(path)
         if self.filenames:
             if os.path.basename(path) in self.filenames:
                 return True
@@ -12,15 +12,17 @@ import json
 import pytz
 from datetime import datetime
 
-from sqlite3 import Connection as SQLite3Connection
-from sqlalchemy import create_engine, event
-from sqlalchemy import Column, ForeignKey, Integer, Boolean, String, Date
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import sessionmaker, relationship, backref
+from sqlite3 import Connection as SQLite3Connection, OperationalError as SQLite3OperationalError
+from sqlalchemy import create_engine, event, func, select, text
+from sqlalchemy import Column, ForeignKey, Index, Integer, Boolean, String, Date, DateTime
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import sessionmaker, relationship, backref, synonym
 from sqlalchemy.types import TypeDecorator, Unicode
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.hybrid import hybrid_property
 
 from soundforest import SoundforestError, SOUNDFOREST_USER_DIR
+from soundforest.checksum import stored_checksum_type
 from soundforest.log import SoundforestLogger
 
 logger = SoundforestLogger().default_stream
@@ -28,6 +30,192 @@ logger = SoundforestLogger().default_stream
 DEFAULT_DATABASE = os.path.join(SOUNDFOREST_USER_DIR, 'soundforest.sqlite')
 Base = declarative_base()
 
+# Keep IN (...) clauses below the sqlite bound variable limit
+MAX_QUERY_VARIABLES = 900
+
+# SQLite performance pragmas set for each connection, with default value and
+# accepted values or type. Defaults can be overridden with settings named
+# sqlite_<pragma>, for example sqlite_journal_mode=delete
+SQLITE_PRAGMAS = (
+    ('journal_mode',    'wal',      ('delete', 'truncate', 'persist', 'memory', 'wal')),
+    ('synchronous',     'normal',   ('off', 'normal', 'full', 'extra')),
+    ('cache_size',      -65536,     int),
+    ('mmap_size',       268435456,  int),
+    ('temp_store',      'memory',   ('default', 'file', 'memory')),
+)
+
+
+# Full text search index of track relative paths and tag values, using the
+# track id as rowid. Tree id is stored to filter results without joining the
+# tracks table. Prefix indexes keep short prefix searches from expanding to
+# thousands of terms. Requires sqlite with FTS5 extension.
+SEARCH_INDEX_TABLE = 'track_search'
+DEFAULT_SEARCH_LIMIT = 100
+# Searches matching more tracks than this are not ranked: bm25 ranking of a
+# word found in most tracks reads every match
+SEARCH_RANK_LIMIT = 2000
+
+SEARCH_INDEX_CREATE = "CREATE VIRTUAL TABLE track_search USING fts5(path, tags, tree_id UNINDEXED, prefix='2 3')"
+SEARCH_INDEX_POPULATE = """
+INSERT INTO track_search (rowid, tree_id, path, tags)
+SELECT tracks.id, tracks.tree_id,
+    substr(tracks.directory || '%s' || tracks.filename, length(trees.path) + 2),
+    (SELECT group_concat(coalesce(tags.value, tag_values.value), ' ') FROM tags
+        LEFT JOIN tag_values ON tag_values.id = tags.value_id
+        WHERE tags.track_id = tracks.id)
+FROM tracks JOIN trees ON trees.id = tracks.tree_id
+""" % os.sep
+SEARCH_INDEX_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS track_search_delete AFTER DELETE ON tracks
+BEGIN
+    DELETE FROM track_search WHERE rowid = old.id;
+END
+"""
+
+
+def has_search_index(session):
+    """Check if database has the full text search index"""
+    return session.execute(
+        text("SELECT name FROM sqlite_master WHERE type='table' AND name=:name"),
+        {'name': SEARCH_INDEX_TABLE}
+    ).first() is not None
+
+
+def search_index_entry(track_id, tree, path, values):
+    """Return search index entry for track path relative to tree and tag values"""
+    if tree is not None and path[:len(tree.path)+1] == tree.path + os.sep:
+        path = path[len(tree.path)+1:]
+
+    return {
+        'track_id': track_id,
+        'tree_id': tree is not None and tree.id or None,
+        'path': path,
+        'tags': u' '.join(values),
+    }
+
+
+def update_search_index(session, entries):
+    """Replace full text search index entries of tracks
+
+    Entries are dictionaries returned by search_index_entry. Does nothing
+    if the database has no search index.
+
+    """
+    if not entries or not has_search_index(session):
+        return
+
+    session.execute(text('DELETE FROM track_search WHERE rowid = :track_id'), entries)
+    session.execute(
+        text('INSERT INTO track_search (rowid, tree_id, path, tags) VALUES (:track_id, :tree_id, :path, :tags)'),
+        entries
+    )
+
+
+def search_tracks(session, match, tree=None, limit=DEFAULT_SEARCH_LIMIT):
+    """Search tracks matching all words as prefixes in tag values or paths
+
+    Tracks are ranked by bm25 using the full text search index, unless the
+    search matches more than SEARCH_RANK_LIMIT tracks. Such results are
+    returned in index order. If the index is not available, tracks with
+    all words in tag values or paths are matched with LIKE, without ranking.
+
+    Returns list of TrackModel objects.
+
+    """
+    words = match.split()
+    if not words:
+        return []
+
+    if not has_search_index(session):
+        query = session.query(TrackModel)
+        if tree is not None:
+            query = query.filter(TrackModel.tree == tree)
+        for word in words:
+            pattern = '%%%s%%' % word
+            query = query.filter(
+                TrackModel.directory.like(pattern) |
+                TrackModel.filename.like(pattern) |
+                TrackModel.tags.any(TagModel.value.like(pattern))
+            )
+        return query.order_by(TrackModel.directory, TrackModel.filename).limit(limit).all()
+
+    sql = 'SELECT rowid FROM track_search WHERE track_search MATCH :match'
+    params = {
+        'match': ' '.join('"%s"*' % word.replace('"', '""') for word in words),
+        'limit': limit,
+    }
+    if tree is not None:
+        sql += ' AND tree_id = :tree_id'
+        params['tree_id'] = tree.id
+
+    params['candidates'] = max(limit, SEARCH_RANK_LIMIT + 1)
+    ids = [row[0] for row in session.execute(text(sql + ' LIMIT :candidates'), params)]
+    if len(ids) > SEARCH_RANK_LIMIT:
+        ids = ids[:limit]
+    else:
+        ids = [row[0] for row in session.execute(text(sql + ' ORDER BY rank LIMIT :limit'), params)]
+    tracks = {}
+    for i in range(0, len(ids), MAX_QUERY_VARIABLES):
+        for track in session.query(TrackModel).filter(TrackModel.id.in_(ids[i:i+MAX_QUERY_VARIABLES])):
+            tracks[track.id] = track
+
+    return [tracks[track_id] for track_id in ids if track_id in tracks]
+
+
+# Setting recording that old tag rows were moved to tag dictionary tables
+TAG_DICTIONARY_SETTING = 'tag_dictionary_migrated'
+
+# Tags with values stored once in tag_values table, instead of each tag row
+DICTIONARY_TAGS = (
+    'album',
+    'album_artist',
+    'artist',
+    'composer',
+    'genre',
+    'year',
+)
+
+
+def intern_value(session, model, value):
+    """Return model object for value in tag dictionary table, adding missing values"""
+    entry = session.query(model).filter(model.key == value).first()
+    if entry is None:
+        entry = model(key=value)
+        session.add(entry)
+    return entry
+
+
+def new_tag(session, track, tag, value):
+    """Return new TagModel for track, with interned tag name and value"""
+    entry = TagModel(track=track, tag_name=intern_value(session, TagNameModel, tag))
+    if tag in DICTIONARY_TAGS:
+        entry.dictionary_value = intern_value(session, TagValueModel, value)
+    else:
+        entry.text_value = value
+    return entry
+
+
+def tag_document(values):
+    """Return tag document stored to TrackModel for list of (tag, value) pairs"""
+    return json.dumps([[tag, value] for tag, value in values], ensure_ascii=False, separators=(',', ':'))
+
+
+def sqlite_pragma_value(name, value, default, accepted):
+    """Return valid value for sqlite pragma, or default for invalid values"""
+    if value is None:
+        return default
+
+    if accepted is int:
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    elif value.lower() in accepted:
+        return value.lower()
+
+    logger.debug('Invalid value for sqlite_%s setting: %s' % (name, value))
+    return default
+
 
 class SafeUnicode(TypeDecorator):
 
@@ -613,6 +801,10 @@ class TreeModel(Base, BasePathNamedModel):
             .filter(TagModel.value.like('%%%s%%' % match))\
             .all()
 
+    def search(self, session, match, limit=DEFAULT_SEARCH_LIMIT):
+        """Search tracks in tree by tag values and paths, see search_tracks"""
+        return search_tracks(session, match, tree=self, limit=limit)
+
     def filter_tracks(self, session, path):
         res = session.query(TrackModel).filter(TrackModel.tree == self)
         return res.filter(
@@ -647,6 +839,9 @@ class AlbumModel(Base, BasePathNamedModel):
     """
 
     __tablename__ = 'albums'
+    __table_args__ = (
+        Index('ix_albums_directory', 'directory'),
+    )
 
     id = Column(Integer, primary_key=True)
 
@@ -744,6 +939,11 @@ class TrackModel(Base, BasePathNamedModel):
     """
 
     __tablename__ = 'tracks'
+    __table_args__ = (
+        Index('ix_tracks_directory_filename', 'directory', 'filename'),
+        Index('ix_tracks_checksum', 'checksum'),
+        Index('ix_tracks_size', 'size'),
+    )
 
     id = Column(Integer, primary_key=True)
 
@@ -751,8 +951,13 @@ class TrackModel(Base, BasePathNamedModel):
     filename = Column(SafeUnicode)
     extension = Column(SafeUnicode)
     checksum = Column(SafeUnicode)
+    checksum_algorithm = Column(SafeUnicode)
+    checksum_mode = Column(SafeUnicode)
     mtime = Column(Integer)
+    size = Column(Integer)
     deleted = Column(Boolean)
+    # Copy of tag rows as JSON list of [tag, value] pairs, see tag_document
+    tag_document = Column(SafeUnicode)
 
     tree_id = Column(Integer, ForeignKey('trees.id'), nullable=True)
     tree = relationship('TreeModel',
@@ -804,42 +1009,116 @@ class TrackModel(Base, BasePathNamedModel):
 
         return tval.isoformat()
 
+    @property
+    def tag_values(self):
+        """List of (tag, value) pairs, read from tag document if available"""
+        if self.tag_document is not None:
+            return [(tag, value) for tag, value in json.loads(self.tag_document)]
+        return [(t.tag, t.value) for t in self.tags]
+
     def update(self, session, track):
         for tag in session.query(TagModel).filter(TagModel.track==self):
             session.delete(tag)
-        for tag, value in track.tags.items():
-            session.add(TagModel(track=self, tag=tag, value=value))
+        values = []
+        for tag, tag_values in track.tags.items():
+            if not isinstance(tag_values, list):
+                tag_values = [tag_values]
+            for value in tag_values:
+                session.add(new_tag(session, self, tag, value))
+                values.append((tag, value))
+        self.tag_document = tag_document(values)
+        update_search_index(session, [
+            search_index_entry(self.id, self.tree, self.path, [value for tag, value in values])
+        ])
         session.commit()
 
+    @property
+    def checksum_type(self):
+        """Algorithm and mode of stored checksum, see stored_checksum_type"""
+        if self.checksum is None:
+            return self.checksum_algorithm, self.checksum_mode
+        return stored_checksum_type(self.checksum_algorithm, self.checksum_mode)
+
     def to_json(self):
+        checksum_algorithm, checksum_mode = self.checksum_type
+
         return json.dumps({
             'id': self.id,
             'filename': self.path,
-            'md5': self.checksum,
+            # Consumers of older versions read file md5 checksums from 'md5'
+            'md5': checksum_algorithm == u'md5' and checksum_mode == u'file' and self.checksum or None,
+            'checksum': self.checksum,
+            'checksum_algorithm': checksum_algorithm,
+            'checksum_mode': checksum_mode,
             'modified': self.modified_isoformat,
-            'tags': dict((t.tag, t.value) for t in self.tags)
+            'size': self.size,
+            'tags': dict(self.tag_values)
         })
 
 
+class TagNameModel(Base):
+    """TagNameModel
+
+    Interned metadata tag name
+
+    """
+
+    __tablename__ = 'tag_names'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(SafeUnicode, unique=True)
+    key = synonym('name')
+
+    def __repr__(self):
+        return self.name
+
+
+class TagValueModel(Base):
+    """TagValueModel
+
+    Interned metadata tag value for tags in DICTIONARY_TAGS
+
+    """
+
+    __tablename__ = 'tag_values'
+
+    id = Column(Integer, primary_key=True)
+    value = Column(SafeUnicode, unique=True)
+    key = synonym('value')
+
+    def __repr__(self):
+        return self.value
+
+
 class TagModel(Base):
     """TagModel
 
     Metadata tag for an audio file
 
+    Tag names are stored in tag_names table. Values of DICTIONARY_TAGS are
+    stored in tag_values table, other values in the tag row. Use new_tag
+    to create tags: tag and value attributes are read only.
+
     """
 
     __tablename__='tags'
+    __table_args__ = (
+        Index('ix_tags_track_id_name_id', 'track_id', 'name_id'),
+    )
 
     id=Column(Integer, primary_key = True)
-    tag=Column(SafeUnicode)
-    value=Column(SafeUnicode)
+    name_id=Column(Integer, ForeignKey('tag_names.id'), nullable = False)
+    tag_name=relationship('TagNameModel', lazy='joined')
+    value_id=Column(Integer, ForeignKey('tag_values.id'), nullable = True)
+    dictionary_value=relationship('TagValueModel', lazy='joined')
+    text_value=Column('value', SafeUnicode)
     base64_encoded=Column(Boolean)
 
     track_id=Column(Integer, ForeignKey('tracks.id'), nullable = False)
     track=relationship('TrackModel',
         single_parent = False,
         backref = backref('tags',
-            order_by=tag,
+            order_by=id,
             cascade='all, delete, delete-orphan'
         )
     )
@@ -847,6 +1126,61 @@ class TagModel(Base):
     def __repr__(self):
         return '%s=%s' % (self.tag, self.value)
 
+    @hybrid_property
+    def tag(self):
+        return self.tag_name.name
+
+    @tag.expression
+    def tag(cls):
+        return select([TagNameModel.name]).where(TagNameModel.id == cls.name_id).as_scalar()
+
+    @hybrid_property
+    def value(self):
+        if self.dictionary_value is not None:
+            return self.dictionary_value.value
+        return self.text_value
+
+    @value.expression
+    def value(cls):
+        return func.coalesce(
+            cls.text_value,
+            select([TagValueModel.value]).where(TagValueModel.id == cls.value_id).as_scalar()
+        )
+
+
+class TestResultModel(Base, BasePathNamedModel):
+    """TestResultModel
+
+    Result of audio file integrity test, valid until file is modified
+
+    """
+
+    __tablename__ = 'testresults'
+    __table_args__ = (
+        Index('ix_testresults_directory_filename', 'directory', 'filename'),
+    )
+
+    id = Column(Integer, primary_key=True)
+
+    directory = Column(SafeUnicode)
+    filename = Column(SafeUnicode)
+    command = Column(SafeUnicode)
+    result = Column(Boolean)
+    mtime = Column(Integer)
+    size = Column(Integer)
+    tested = Column(DateTime)
+
+    def __repr__(self):
+        return '%s %s' % (self.result and 'OK' or 'NOK', self.path)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.filename)
+
+    def is_valid(self, command, mtime, size):
+        """Check if result applies to file with given tester, mtime and size"""
+        return self.command == command and self.mtime == mtime and self.size == size
+
 
 class SoundforestDB(object):
 
@@ -874,18 +1208,188 @@ class SoundforestDB(object):
 
             engine = create_engine('sqlite:///%s' % path, encoding='utf-8', echo=debug)
 
-        event.listen(engine, 'connect', self._fk_pragma_on_connect)
+        event.listen(engine, 'connect', self._sqlite_pragmas_on_connect)
         Base.metadata.create_all(engine)
+        self._add_missing_columns(engine)
+        self._intern_tag_rows(engine)
+        self._add_missing_indexes(engine)
+        self._create_search_index(engine)
 
         session_instance = sessionmaker(bind=engine)
         self.session = session_instance()
 
-    def _fk_pragma_on_connect(self, connection, record):
-        """Enable foreign keys for sqlite databases"""
-        if isinstance(connection, SQLite3Connection):
-            cursor = connection.cursor()
-            cursor.execute('pragma foreign_keys=ON')
-            cursor.close()
+    def _sqlite_pragmas_on_connect(self, connection, record):
+        """Enable foreign keys and set performance pragmas for sqlite databases
+
+        Pragma settings are read directly from settings table, which does
+        not exist yet when a new database is created.
+
+        """
+        if not isinstance(connection, SQLite3Connection):
+            return
+
+        cursor = connection.cursor()
+        cursor.execute('pragma foreign_keys=ON')
+
+        settings = {}
+        try:
+            cursor.execute("SELECT key, value FROM settings WHERE key LIKE 'sqlite_%'")
+            settings = dict(cursor.fetchall())
+        except SQLite3OperationalError:
+            pass
+
+        for name, default, accepted in SQLITE_PRAGMAS:
+            value = sqlite_pragma_value(name, settings.get('sqlite_%s' % name), default, accepted)
+            cursor.execute('pragma %s=%s' % (name, value))
+            if name == 'journal_mode':
+                # journal_mode returns the mode in use
+                cursor.fetchall()
+
+        cursor.close()
+
+    def _add_missing_columns(self, engine):
+        """Add new columns to existing sqlite database tables
+
+        create_all only creates missing tables: columns added to models after
+        the database was created are added here with ALTER TABLE.
+
+        """
+        if engine.dialect.name != 'sqlite':
+            return
+
+        connection = engine.connect()
+        try:
+            for table in Base.metadata.sorted_tables:
+                columns = [row[1] for row in connection.execute('PRAGMA table_info(%s)' % table.name)]
+                for column in table.columns:
+                    if column.name in columns:
+                        continue
+
+                    connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                        table.name,
+                        column.name,
+                        column.type.compile(dialect=engine.dialect)
+                    ))
+        finally:
+            connection.close()
+
+    def _intern_tag_rows(self, engine):
+        """Move tag names and dictionary values of old tag rows to tag tables
+
+        Tag rows created before tag_names and tag_values tables have the tag
+        name in the tag column, which is cleared here. Finished migration is
+        recorded in settings table, so the tags table is not scanned again.
+
+        """
+        if engine.dialect.name != 'sqlite':
+            return
+
+        connection = engine.connect()
+        try:
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(tags)')]
+            if 'tag' not in columns:
+                return
+
+            migrated = connection.execute(
+                'SELECT value FROM settings WHERE key = ?', (TAG_DICTIONARY_SETTING,)
+            ).first()
+            if migrated is not None:
+                return
+
+            logger.debug('Moving tag names and values to tag dictionary tables')
+            dictionary_tags = ', '.join("'%s'" % tag for tag in DICTIONARY_TAGS)
+            transaction = connection.begin()
+            connection.execute(
+                'INSERT OR IGNORE INTO tag_names (name) '
+                'SELECT DISTINCT tag FROM tags WHERE tag IS NOT NULL'
+            )
+            connection.execute(
+                'UPDATE tags SET name_id = (SELECT id FROM tag_names WHERE name = tags.tag) '
+                'WHERE tag IS NOT NULL'
+            )
+            connection.execute(
+                'INSERT OR IGNORE INTO tag_values (value) '
+                'SELECT DISTINCT value FROM tags WHERE tag IN (%s) AND value IS NOT NULL' % dictionary_tags
+            )
+            connection.execute(
+                'UPDATE tags SET value_id = (SELECT id FROM tag_values WHERE tag_values.value = tags.value), '
+                'value = NULL WHERE tag IN (%s) AND value IS NOT NULL' % dictionary_tags
+            )
+            connection.execute('UPDATE tags SET tag = NULL WHERE tag IS NOT NULL')
+            connection.execute('DROP INDEX IF EXISTS ix_tags_track_id_tag')
+            connection.execute(
+                'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                (TAG_DICTIONARY_SETTING, u'1')
+            )
+            transaction.commit()
+        finally:
+            connection.close()
+
+    def _add_missing_indexes(self, engine):
+        """Add new indexes to existing sqlite database tables
+
+        create_all only creates indexes of new tables: indexes added to models
+        after the database was created are added here.
+
+        """
+        if engine.dialect.name != 'sqlite':
+            return
+
+        connection = engine.connect()
+        try:
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    connection.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+                        index.name,
+                        table.name,
+                        ', '.join(column.name for column in index.columns)
+                    ))
+        finally:
+            connection.close()
+
+    def _create_search_index(self, engine):
+        """Create full text search index for sqlite databases
+
+        Index is populated from existing tracks and tags when created. Rows
+        of removed tracks are deleted by a trigger. An index created with
+        different options is rebuilt. If sqlite has no FTS5 extension,
+        searches use LIKE queries instead.
+
+        """
+        if engine.dialect.name != 'sqlite':
+            return
+
+        connection = engine.connect()
+        try:
+            existing = connection.execute(
+                text("SELECT sql FROM sqlite_master WHERE type='table' AND name=:name"),
+                name=SEARCH_INDEX_TABLE
+            ).first()
+            if existing is None or existing[0] != SEARCH_INDEX_CREATE:
+                transaction = connection.begin()
+                if existing is not None:
+                    logger.debug('Rebuilding full text search index')
+                    connection.execute('DROP TABLE %s' % SEARCH_INDEX_TABLE)
+                try:
+                    connection.execute(SEARCH_INDEX_CREATE)
+                except OperationalError, emsg:
+                    transaction.rollback()
+                    logger.debug('Full text search index not available: %s' % emsg)
+                    return
+                connection.execute(SEARCH_INDEX_POPULATE)
+                transaction.commit()
+
+            connection.execute(SEARCH_INDEX_TRIGGER)
+        finally:
+            connection.close()
+
+    def update_search_index(self, entries):
+        """Replace full text search index entries of tracks, see update_search_index"""
+        update_search_index(self.session, entries)
+
+    def search(self, match, tree=None, limit=DEFAULT_SEARCH_LIMIT):
+        """Search tracks by tag values and paths, see search_tracks"""
+        return search_tracks(self.session, match, tree=tree, limit=limit)
 
     def query(self, *args, **kwargs):
         """Wrapper to do a session query"""
@@ -1158,6 +1662,36 @@ class SoundforestDB(object):
             TrackModel.filename == os.path.basename(path),
         ).first()
 
+    def get_test_result(self, path):
+        """Return cached integrity test result for path
+
+        Results are stored by real path, so relative paths and symlinks to
+        the same file share the cached result.
+
+        """
+        path = os.path.realpath(path)
+        return self.query(TestResultModel).filter(
+            TestResultModel.directory == os.path.dirname(path),
+            TestResultModel.filename == os.path.basename(path),
+        ).first()
+
+    def update_test_result(self, path, command, result, mtime, size):
+        """Store integrity test result for real path of path"""
+        path = os.path.realpath(path)
+        entry = self.get_test_result(path)
+        if entry is None:
+            entry = TestResultModel(
+                directory=os.path.dirname(path),
+                filename=os.path.basename(path)
+            )
+
+        entry.command = command
+        entry.result = result
+        entry.mtime = mtime
+        entry.size = size
+        entry.tested = datetime.now()
+        self.add(entry)
+
     def get_playlist_tree(self, path):
         return self.query(PlaylistTreeModel).filter(
             PlaylistTreeModel.path == path
@@ -32,6 +32,24 @@ for i in range(0, len(ITUNES_PARTS) + 1):
 class PrefixError(Exception): pass
 
 
+def path_ancestors(path):
+    """Return path and its parent directories, longest first"""
+    path = path.rstrip(os.sep)
+    ancestors = []
+    while path:
+        ancestors.append(path)
+        index = path.rfind(os.sep)
+        if index < 0:
+            break
+        path = path[:index]
+    return ancestors
+
+
+def has_prefix(path, prefix):
+    """Check if path is prefix or a path under prefix directory"""
+    return path == prefix or path[:len(prefix)+1] == prefix + os.sep
+
+
 class MusicTreePrefix(object):
 
     """MusicTreePrefix
@@ -42,6 +60,8 @@ class MusicTreePrefix(object):
     def __init__(self, path, extensions=[]):
         self.log = SoundforestLogger().default_stream
         self.path = path.rstrip(os.sep)
+        # Resolved once: prefixes are matched for every file in trees
+        self.realpath = os.path.realpath(self.path)
 
         if not isinstance(extensions, list):
             raise PrefixError('Extensions must be a list')
@@ -66,17 +86,11 @@ class MusicTreePrefix(object):
         else:
             return self.path
 
-    @property
-    def realpath(self):
-        return os.path.realpath(self.path)
-
     def match(self, path):
-        if path[:len(self.path)] == self.path:
+        if has_prefix(path, self.path) or has_prefix(path, self.realpath):
             return True
 
-        realpath = os.path.realpath(path)
-        mypath = os.path.realpath(self.path)
-        if realpath[:len(mypath)] == mypath:
+        if has_prefix(os.path.realpath(path), self.realpath):
             return True
 
         return False
@@ -88,14 +102,15 @@ class MusicTreePrefix(object):
 
     def relative_path(self, path):
         path = path.rstrip(os.sep)
-        if path[:len(self.path)] == self.path:
+        if has_prefix(path, self.path):
             return path_string(path[len(self.path):].lstrip(os.sep))
 
-        realpath = os.path.realpath(path)
-        mypath = os.path.realpath(self.path)
+        if has_prefix(path, self.realpath):
+            return path_string(path[len(self.realpath):].lstrip(os.sep))
 
-        if realpath[:len(mypath)] == mypath:
-            return path_string(realpath[len(mypath):].lstrip(os.sep))
+        realpath = os.path.realpath(path)
+        if has_prefix(realpath, self.realpath):
+            return path_string(realpath[len(self.realpath):].lstrip(os.sep))
 
         raise PrefixError('Prefix does not match: %s' % path)
 
@@ -116,10 +131,21 @@ class TreePrefixes(object):
 
     class TreePrefixInstance(list):
 
+        """TreePrefixInstance
+
+        Prefixes are matched with an index mapping prefix paths and resolved
+        prefix realpaths to position in this list: a lookup checks the path
+        and its parent directories from the index, and the first registered
+        matching prefix wins. Realpaths of looked up directories are cached.
+
+        """
+
         def __init__(self):
             self.log = SoundforestLogger().default_stream
             list.__init__(self)
             self.db = ConfigDB()
+            self.prefix_index = None
+            self.realpath_cache = {}
 
             common_prefixes = set(DEFAULT_PATHS + [prefix.path for prefix in self.db.prefixes])
 
@@ -198,6 +224,8 @@ class TreePrefixes(object):
             if not isinstance(prefix, MusicTreePrefix):
                 raise PrefixError('prefix must be string or MusicTreePrefix instance')
 
+            self.prefix_index = None
+
             try:
                 index = self.index(prefix)
                 if prepend and index != 0:
@@ -222,23 +250,59 @@ class TreePrefixes(object):
 
             return None
 
-        def match(self, path, match_existing=False):
-            for prefix in self:
-
+        def update_index(self):
+            """Build index of prefix paths and realpaths"""
+            self.prefix_index = {}
+            for index, prefix in enumerate(self):
+                for path in (prefix.path, prefix.realpath):
+                    if path not in self.prefix_index:
+                        self.prefix_index[path] = index
+
+        def realpath(self, path):
+            """Return realpath for path, caching resolved directories"""
+            directory, filename = os.path.split(path.rstrip(os.sep))
+            if directory not in self.realpath_cache:
+                self.realpath_cache[directory] = os.path.realpath(directory)
+
+            realpath = os.path.join(self.realpath_cache[directory], filename)
+            if os.path.islink(realpath):
+                realpath = os.path.realpath(realpath)
+            return realpath
+
+        def __match_index__(self, path, match_existing=False):
+            if self.prefix_index is None:
+                self.update_index()
+
+            matches = []
+            for ancestor in path_ancestors(path):
+                if ancestor in self.prefix_index:
+                    matches.append(self.prefix_index[ancestor])
+
+            for index in sorted(matches):
+                prefix = self[index]
                 if match_existing and not os.path.isdir(prefix.path):
                     continue
-
-                if prefix.match(path):
-                    return prefix
+                return prefix
 
             return None
 
+        def match(self, path, match_existing=False):
+            prefix = self.__match_index__(path, match_existing)
+            if prefix is None:
+                prefix = self.__match_index__(self.realpath(path), match_existing)
+            return prefix
+
         def relative_path(self, path):
-            prefix = self.match(path)
-            if not prefix:
-                return path
+            prefix = self.__match_index__(path)
+            if prefix is not None:
+                return prefix.relative_path(path)
+
+            realpath = self.realpath(path)
+            prefix = self.__match_index__(realpath)
+            if prefix is not None:
+                return prefix.relative_path(realpath)
 
-            return prefix.relative_path(path)
+            return path
 
     def __getattr__(self, attr):
         return getattr(self.__instance, attr)
@@ -5,11 +5,8 @@ Abstraction for album art image format processing
 """
 
 import os
-import requests
 import StringIO
 
-from PIL import ImageFile
-
 DEFAULT_ARTWORK_FILENAME = 'artwork.jpg'
 
 PIL_EXTENSION_MAP = {
@@ -69,6 +66,9 @@ class AlbumArt(object):
         Load the image from data with PIL
         """
 
+        # Imported here to keep PIL out of command startup
+        from PIL import ImageFile
+
         try:
             parser = ImageFile.Parser()
             parser.feed(data)
@@ -173,6 +173,9 @@ class AlbumArt(object):
             raise AlbumArtError('Error saving %s: %s' % (path, emsg))
 
     def fetch(self, url):
+        # Imported here to keep requests out of command startup
+        import requests
+
         res = requests.get(url)
         if res.status_code!=200:
             raise AlbumArtError('Error fetching url %s (returns %s' % (url, res.status_code))
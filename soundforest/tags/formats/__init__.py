@@ -11,3 +11,32 @@ __all__ = [
     'vorbis'
 ]
 
+
+TAG_PARSERS = {
+    'm4a':      'soundforest.tags.formats.aac.aac',
+    'm4r':      'soundforest.tags.formats.aac.aac',
+    'mp3':      'soundforest.tags.formats.mp3.mp3',
+    'flac':     'soundforest.tags.formats.flac.flac',
+    'vorbis':   'soundforest.tags.formats.vorbis.vorbis',
+}
+
+def get_tag_parser(codec_name):
+    """Return tag parser class for codec name
+
+    Returns None if tags are not supported for the codec. Does not access
+    the configuration database, so it is safe to call in worker processes.
+
+    """
+    if codec_name not in TAG_PARSERS.keys():
+        return None
+
+    try:
+        classpath = TAG_PARSERS[codec_name]
+        module_path = '.'.join(classpath.split('.')[:-1])
+        class_name = classpath.split('.')[-1]
+        m = __import__(module_path, globals(), fromlist=[class_name])
+
+    except KeyError, emsg:
+        return None
+
+    return getattr(m, class_name)
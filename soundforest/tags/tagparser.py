@@ -16,7 +16,6 @@ from soundforest.log import SoundforestLogger
 from soundforest.formats import AudioFileFormat
 from soundforest.tags import TagError
 from soundforest.tags.constants import STANDARD_TAG_ORDER, STANDARD_TAG_MAP
-from soundforest.tags.xmltag import XMLTags, XMLTagError
 from soundforest.tags.albumart import AlbumArt, AlbumArtError
 
 __all__ = (
@@ -315,6 +314,8 @@ class TagParser(dict):
         """
         Return tags formatted as XML
         """
+        # Imported here to keep lxml out of command startup
+        from soundforest.tags.xmltag import XMLTags
         return XMLTags(self.as_dict())
 
     def to_json(self, indent=2):
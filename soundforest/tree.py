@@ -10,15 +10,95 @@ import re
 import shutil
 import time
 
+from array import array
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
+
 from soundforest import normalized, SoundforestError, TreeError
 from soundforest.log import SoundforestLogger
 from soundforest.formats import AudioFileFormat, path_string, match_codec, match_metadata
 from soundforest.prefixes import TreePrefixes, PrefixError
+from soundforest.walker import scan_directory, walk
 from soundforest.metadata import CoverArt
 from soundforest.tags import TagError
 from soundforest.tags.albumart import AlbumArt, AlbumArtError
 from soundforest.tags.tagparser import Tags
 
+TEST_POLL_INTERVAL = 1
+
+
+def run_track_test(track, cmd, tempfile_path):
+    """Run tester command for track in a worker thread
+
+    Returns tuple of track, return value, stdout and stderr. Any error is
+    returned as a failed result: pool callbacks are not called for worker
+    exceptions, and the test would never complete.
+
+    """
+    try:
+        rv, stdout, stderr = track.run_test(cmd, tempfile_path)
+    except (OSError, TreeError), emsg:
+        return track, 1, None, str(emsg)
+    except Exception, emsg:
+        return track, 1, None, 'Error running tester: %s' % repr(emsg)
+
+    return track, rv, stdout, stderr
+
+
+class FileListing(object):
+    """FileListing
+
+    Compact listing of files in a tree. Each directory path is stored once in
+    a directory table, and files as index to the directory table and filename.
+
+    Items are returned as (directory, filename) tuples.
+
+    """
+
+    def __init__(self):
+        self.directories = []
+        self.file_directories = array('L')
+        self.filenames = []
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[index] for index in xrange(*item.indices(len(self)))]
+        return self.directories[self.file_directories[item]], self.filenames[item]
+
+    def __getslice__(self, start, stop):
+        return self[max(0, start):max(0, stop):1]
+
+    def __delslice__(self, start, stop):
+        if start > 0 or stop < len(self):
+            raise TreeError('Only whole file listing can be removed')
+        self.clear()
+
+    def __iter__(self):
+        directories = self.directories
+        for index, filename in enumerate(self.filenames):
+            yield directories[self.file_directories[index]], filename
+
+    def clear(self):
+        """Remove all directories and files from listing"""
+        self.directories = []
+        self.file_directories = array('L')
+        self.filenames = []
+
+    def append_directory(self, directory, filenames):
+        """Add files in directory to listing"""
+        index = len(self.directories)
+        self.directories.append(directory)
+        self.file_directories.extend([index] * len(filenames))
+        self.filenames.extend(filenames)
+
+    def paths(self):
+        """Iterate joined paths of files in listing"""
+        for directory, filename in self:
+            yield os.path.join(directory, filename)
+
 
 class IterableTrackFolder(object):
     """IterableTrackFolder model
@@ -69,7 +149,7 @@ class IterableTrackFolder(object):
             self.__next += 1
             path = os.path.join(entry[0], entry[1])
             try:
-                return Track(path)
+                return self.get_track(entry)
             except TreeError:
                 if not self.invalid_paths.count(path):
                     self.invalid_paths.append(path)
@@ -79,6 +159,10 @@ class IterableTrackFolder(object):
             self.has_been_iterated = True
             raise StopIteration
 
+    def get_track(self, entry):
+        """Return Track for (directory, filename) entry"""
+        return Track(os.path.join(entry[0], entry[1]))
+
     def load(self):
         """Lazy loader of the iterable item"""
         iterable = getattr(self, self.__iterable)
@@ -127,27 +211,20 @@ class Tree(IterableTrackFolder):
 
     def __init__(self, path):
         IterableTrackFolder.__init__(self, path, 'files')
-        self.paths = {}
+        self.files = FileListing()
         self.empty_dirs = []
         self.relative_dirs = []
 
     def __len__(self):
         """
-        Tree must be loaded to figure out it's length
+        Number of audio files in tree, matched by filename without loading
+        tracks. Tree is walked without storing the files if not yet loaded.
         """
-        if not self.has_been_iterated:
-            self.has_been_iterated = True
-            while True:
-                try:
-                    self.next()
-                except StopIteration:
-                    break
-        return IterableTrackFolder.__len__(self)
-
-    def __cmp_file_path__(self, a, b):
-        if a[0] != b[0]:
-            return cmp(a[0], b[0])
-        return cmp(a[1], b[1])
+        if len(self.files):
+            filenames = self.files.filenames
+        else:
+            filenames = (entry.name for root, dirs, files in walk(self.path) for entry in files)
+        return sum(1 for filename in filenames if match_codec(filename) is not None)
 
     def load(self):
         """Load the albums and songs in the tree"""
@@ -159,23 +236,37 @@ class Tree(IterableTrackFolder):
         start = long(time.mktime(time.localtime()))
 
         IterableTrackFolder.load(self)
-        self.paths = {}
         self.empty_dirs = []
         self.relative_dirs = []
-        for (root, dirs, files) in os.walk(self.path, topdown=True):
+        for (root, dirs, files) in walk(self.path):
             if files:
-                self.files.extend((root, x) for x in files)
-                for x in files:
-                    self.paths[os.path.join(root, x)] = True
+                self.files.append_directory(root, [entry.name for entry in files])
             elif not dirs:
                 self.empty_dirs.append(root)
 
-        self.relative_dirs = set(self.relative_path(x[0]) for x in self.files)
-        self.files.sort(lambda x, y: self.__cmp_file_path__(x, y))
+        self.relative_dirs = set(self.relative_path(x) for x in self.files.directories)
 
         stop = long(time.mktime(time.localtime()))
         self.log.debug('loaded %d files in %d seconds' % (len(self.files), (stop-start)))
 
+    def iter_albums(self):
+        """Iterate albums while walking the tree
+
+        Yields Album objects for directories containing files, loaded from
+        the walked directory entries. The file listing of the whole tree is
+        not loaded to memory.
+
+        """
+        if not os.path.isdir(self.path):
+            raise TreeError('Not a directory: %s' % self.path)
+
+        for (root, dirs, files) in walk(self.path):
+            if not files:
+                continue
+            album = Album(root)
+            album.load_entries(files)
+            yield album
+
     def filter_tracks(self, regexp=None, re_path=True, re_file=True, as_tracks=False):
         if not len(self.files):
             self.load()
@@ -198,35 +289,101 @@ class Tree(IterableTrackFolder):
 
     @property
     def directories(self):
-        return set(normalized(os.path.dirname(x)) for x in self.paths.keys())
+        return set(normalized(x) for x in self.files.directories)
 
     @property
     def realpaths(self):
-        return dict((normalized(os.path.realpath(v)), True) for v in self.paths.keys())
+        return dict((normalized(self.prefixes.realpath(v)), True) for v in self.files.paths())
 
     def contains(self, path):
-        directory = os.path.dirname(path)
-        filename = os.path.filename(path)
+        directory, filename = os.path.split(path)
+        for entry in self.files:
+            if entry[0] == directory and entry[1] == filename:
+                return True
+        return False
 
     def as_albums(self):
         if not self.has_been_iterated:
             self.load()
-        return [Album(path) for path in sorted(set(d[0] for d in self.files))]
+        return [Album(path) for path in self.files.directories]
 
     def match(self, path):
         relative_path = self.relative_path(path)
         if not os.path.dirname(relative_path) in self.relative_dirs:
             return None
 
-    def test(self, callback):
+    def test(self, callback, jobs=1, db=None, force=False):
+        """Test integrity of tracks in tree
+
+        Runs up to jobs tester commands in parallel. Tester commands are
+        resolved in this thread: worker threads only run the commands.
+        Results are passed to callback in order of completion.
+
+        If db is given, test results are stored to database and tracks with
+        a valid stored result are not tested again unless force is set.
+
+        """
+        if jobs <= 1:
+            errors = False
+            for track in self:
+                if track.test(callback, db=db, force=force) != 0:
+                    errors = True
+            return errors and 1 or 0
+
+        def next_result():
+            while True:
+                try:
+                    return results.get(True, TEST_POLL_INTERVAL)
+                except Empty:
+                    continue
+
         errors = False
-        for track in self:
-            if track.test(callback) != 0:
-                errors = True
-        if errors:
-            return 1
-        else:
-            return 0
+        pending = 0
+        results = Queue()
+        pool = ThreadPool(jobs)
+
+        def report(result):
+            track = result[0]
+            rv = track.report_test(callback, *result[1:])
+            if db is not None:
+                track.save_test_result(db, rv)
+            return rv
+
+        try:
+            for track in self:
+                if db is not None and not force:
+                    cached = track.get_cached_test_result(db)
+                    if cached is not None:
+                        if track.report_cached_test(callback, cached) != 0:
+                            errors = True
+                        continue
+
+                tempfile_path = track.get_temporary_file(prefix='test', suffix='.wav')
+                try:
+                    cmd = track.get_tester_command(tempfile_path)
+                except TreeError, emsg:
+                    callback(track, False, errors='No tester available for %s' % track.extension)
+                    errors = True
+                    continue
+
+                pool.apply_async(run_track_test, (track, cmd, tempfile_path), callback=results.put)
+                pending += 1
+
+                while pending >= jobs:
+                    if report(next_result()) != 0:
+                        errors = True
+                    pending -= 1
+
+            while pending > 0:
+                if report(next_result()) != 0:
+                    errors = True
+                pending -= 1
+
+        finally:
+            pool.close()
+            pool.join()
+
+        return errors and 1 or 0
 
 
 class Album(IterableTrackFolder):
@@ -234,40 +391,81 @@ class Album(IterableTrackFolder):
     def __init__(self, path):
         IterableTrackFolder.__init__(self, path, 'files')
         self.metadata_files = []
+        self.file_entries = {}
+        self.entries_loaded = False
+        self.__stat = None
 
     def __repr__(self):
         return 'album %s' % self.path
 
     def __getitem__(self, item):
         item = IterableTrackFolder.__getitem__(self, item)
-        return Track(os.path.join(*item))
+        return self.get_track(item)
+
+    def get_track(self, entry):
+        """Return Track for entry, with stat information from directory scan"""
+        try:
+            stat = self.file_entries[entry[1]].stat()
+        except (KeyError, OSError):
+            stat = None
+        return Track(os.path.join(entry[0], entry[1]), stat=stat)
 
     def load(self):
+        directories, files = scan_directory(self.path)
+        self.load_entries(files)
+
+    def iter_records(self):
+        """Iterate TrackRecords of album audio files"""
+        if not self.entries_loaded:
+            self.load()
+
+        for directory, filename in self.files:
+            try:
+                stat = self.file_entries[filename].stat()
+            except (KeyError, OSError):
+                stat = None
+            yield TrackRecord(directory, filename, match_codec(filename), stat)
+
+    def load_entries(self, files):
+        """Load album files from directory entries of album directory"""
         IterableTrackFolder.load(self)
 
+        self.__stat = None
         self.metadata_files = []
-        for f in os.listdir(self.path):
-            if match_codec(f) is not None:
-                self.files.append((self.path, f))
+        self.file_entries = {}
+        self.entries_loaded = True
+        for entry in files:
+            if match_codec(entry.name) is not None:
+                self.files.append((self.path, entry.name))
+                self.file_entries[entry.name] = entry
 
             else:
-                metadata = match_metadata(f)
+                # Only symlinks need to be resolved to match target filename
+                if entry.is_symlink():
+                    metadata = match_metadata(entry.path)
+                else:
+                    metadata = match_metadata(entry.path, resolve=False)
                 if metadata is not None:
-                    self.metadata_files.append(MetaDataFile(os.path.join(self.path, f), metadata))
+                    self.metadata_files.append(MetaDataFile(entry.path, metadata))
 
-        self.files.sort()
+    @property
+    def stat(self):
+        """Stat of album directory, cached until album is loaded again"""
+        if self.__stat is None:
+            self.__stat = os.stat(self.path)
+        return self.__stat
 
     @property
     def mtime(self):
-        return os.stat(self.path).st_mtime
+        return self.stat.st_mtime
 
     @property
     def ctime(self):
-        return os.stat(self.path).st_ctime
+        return self.stat.st_ctime
 
     @property
     def atime(self):
-        return os.stat(self.path).st_atime
+        return self.stat.st_atime
 
     @property
     def metadata(self):
@@ -324,6 +522,7 @@ class Album(IterableTrackFolder):
                 if tags.set_albumart(albumart):
                     self.log.debug('albumart: %s' % track)
                     tags.save()
+                    track.refresh()
 
 
 class MetaDataFile(object):
@@ -358,6 +557,60 @@ class MetaDataFile(object):
     def filename(self):
         return os.path.basename(self.path)
 
+class TrackRecord(object):
+    """TrackRecord
+
+    Lightweight audio file record for scanning and database updates, with
+    only the path components, codec and stat of the file. Use as_track() to
+    get a Track for tags, testing or transcoding.
+
+    Directory and filename are kept as found on filesystem, without unicode
+    normalization, so path can always be opened.
+
+    """
+
+    __slots__ = ('directory', 'filename', 'codec', 'stat')
+
+    def __init__(self, directory, filename, codec, stat=None):
+        self.directory = directory
+        self.filename = filename
+        self.codec = codec
+        self.stat = stat
+
+    def __repr__(self):
+        return '%s %s' % (self.codec, self.path)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.filename)
+
+    @property
+    def extension(self):
+        return os.path.splitext(self.filename)[1][1:]
+
+    @property
+    def size(self):
+        if self.stat is None:
+            return None
+        return self.stat.st_size
+
+    @property
+    def ctime(self):
+        if self.stat is None:
+            return None
+        return self.stat.st_ctime
+
+    @property
+    def mtime(self):
+        if self.stat is None:
+            return None
+        return self.stat.st_mtime
+
+    def as_track(self):
+        """Return Track for this record"""
+        return Track(self.path, stat=self.stat)
+
+
 class Track(AudioFileFormat):
     """Track
 
@@ -365,8 +618,8 @@ class Track(AudioFileFormat):
 
     """
 
-    def __init__(self, path):
-        AudioFileFormat.__init__(self, path)
+    def __init__(self, path, stat=None):
+        AudioFileFormat.__init__(self, path, stat=stat)
         self.prefixes = TreePrefixes()
         if self.codec is None:
             raise TreeError('Not a music file: %s' % self.path)
@@ -386,7 +639,7 @@ class Track(AudioFileFormat):
 
     @property
     def relative_path(self):
-        return self.prefixes.relative_path(os.path.realpath(self.path))
+        return self.prefixes.relative_path(self.path)
 
     @property
     def extension(self):
@@ -452,10 +705,15 @@ class Track(AudioFileFormat):
         encoder[encoder.index('FILE')] = wav_path
         return encoder
 
+    @property
+    def tester(self):
+        """Tester command template for track, None if no tester is available"""
+        testers = self.get_available_testers()
+        return testers and testers[0] or None
+
     def get_tester_command(self, tempfile_path):
-        try:
-            tester = self.get_available_testers()[0]
-        except IndexError:
+        tester = self.tester
+        if tester is None:
             raise TreeError('No available testers for %s' % self.path)
 
         tester = tester.split()
@@ -465,24 +723,71 @@ class Track(AudioFileFormat):
 
         return tester
 
-    def test(self, callback):
-        tempfile_path = self.get_temporary_file(prefix='test', suffix='.wav')
-        try:
-            cmd = self.get_tester_command(tempfile_path)
-        except TreeError, emsg:
-            callback(self, False, errors='No tester available for %s' % self.extension)
-            return
+    def run_test(self, cmd, tempfile_path):
+        """Run tester command and remove temporary file
 
+        Does not access the configuration database, so this is safe to call
+        from worker threads. Returns tuple of return value, stdout and stderr.
+
+        """
         rv, stdout, stderr = self.execute(cmd)
-        if rv == 0:
-            callback(self, True, stdout=stdout, stderr=stderr)
-        else:
-            callback(self, False, stdout=stdout, stderr=stderr)
 
         if os.path.isfile(tempfile_path):
             try:
                 os.unlink(tempfile_path)
-            except IOError, (ecode, emsg):
+            except OSError, (ecode, emsg):
                 raise TreeError('Error removing temporary file %s: %s' % (tempfile_path, emsg))
 
+        return rv, stdout, stderr
+
+    def report_test(self, callback, rv, stdout, stderr):
+        """Pass tester command result to callback"""
+        if rv == 0:
+            callback(self, True, stdout=stdout, stderr=stderr)
+        else:
+            callback(self, False, stdout=stdout, stderr=stderr)
+        return rv
+
+    def get_cached_test_result(self, db):
+        """Return stored test result for track
+
+        Returns None if there is no stored result, or the track has been
+        modified or tester command changed after the test.
+
+        """
+        entry = db.get_test_result(self.path)
+        if entry is None or not entry.is_valid(self.tester, self.mtime, self.size):
+            return None
+        return entry.result
+
+    def save_test_result(self, db, rv):
+        """Store tester command result to database"""
+        db.update_test_result(self.path, self.tester, rv == 0, self.mtime, self.size)
+
+    def report_cached_test(self, callback, result):
+        """Pass stored test result to callback"""
+        if result:
+            callback(self, True)
+            return 0
+        else:
+            callback(self, False, errors='Failed in previous test')
+            return 1
+
+    def test(self, callback, db=None, force=False):
+        if db is not None and not force:
+            cached = self.get_cached_test_result(db)
+            if cached is not None:
+                return self.report_cached_test(callback, cached)
+
+        tempfile_path = self.get_temporary_file(prefix='test', suffix='.wav')
+        try:
+            cmd = self.get_tester_command(tempfile_path)
+        except TreeError, emsg:
+            callback(self, False, errors='No tester available for %s' % self.extension)
+            return
+
+        rv, stdout, stderr = self.run_test(cmd, tempfile_path)
+        rv = self.report_test(callback, rv, stdout, stderr)
+        if db is not None:
+            self.save_test_result(db, rv)
         return rv
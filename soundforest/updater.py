@@ -0,0 +1,651 @@
+# coding=utf-8
+"""Tree database updates
+
+Batched updates of filesystem tree albums, tracks and tags to database
+
+"""
+
+import os
+import unicodedata
+
+from itertools import imap, islice
+from multiprocessing import Pool
+from sqlalchemy import select, bindparam
+
+from soundforest import models, TreeError
+from soundforest.checksum import track_checksum, new_hash, effective_checksum_mode, stored_checksum_type, ChecksumError
+from soundforest.checksum import DEFAULT_CHECKSUM_ALGORITHM, DEFAULT_CHECKSUM_MODE
+from soundforest.log import SoundforestLogger
+from soundforest.tags import TagError
+from soundforest.tags.formats import get_tag_parser
+
+DEFAULT_BATCH_SIZE = 500
+WORKER_CHUNK_SIZE = 16
+
+MAX_QUERY_VARIABLES = models.MAX_QUERY_VARIABLES
+
+
+def read_track_info(job):
+    """Read tags and checksum for a track
+
+    Called in worker processes: only plain values are passed in and out and
+    the configuration database is not accessed. Job is a tuple of job index,
+    path, codec name, flag to read tags, checksum algorithm (None to skip
+    checksum) and checksum mode.
+
+    Returns a dictionary with tags as list of (tag, value) pairs. Any error
+    reading the file is returned as the error value: an exception raised in
+    a worker would abort the whole update.
+
+    """
+    index, path, codec_name, read_tags, checksum_algorithm, checksum_mode = job
+    info = {'job': index, 'path': path, 'tags': None, 'checksum': None, 'error': None}
+
+    try:
+        if read_tags:
+            info['tags'] = []
+            parser = get_tag_parser(codec_name)
+            if parser is not None:
+                for tag, values in parser(codec_name, path).items():
+                    if not isinstance(values, list):
+                        values = [values]
+                    for value in values:
+                        info['tags'].append((tag, value))
+
+        if checksum_algorithm is not None:
+            info['checksum'] = track_checksum(path, codec_name, checksum_algorithm, checksum_mode)
+
+    except TagError, emsg:
+        info['error'] = 'Error loading tags: %s' % emsg
+    except ChecksumError, emsg:
+        info['error'] = 'Error calculating checksum: %s' % emsg
+    except IOError, (ecode, emsg):
+        info['error'] = 'Error reading file: %s' % emsg
+    except Exception, emsg:
+        # Parsers raise their own errors for corrupt and truncated files
+        info['error'] = 'Error reading file: %s' % repr(emsg)
+
+    return info
+
+
+def chunks(values, size=MAX_QUERY_VARIABLES):
+    """Split list of values to lists of given size"""
+    for i in range(0, len(values), size):
+        yield values[i:i+size]
+
+
+def album_key(directory):
+    """Return lookup key for album directory
+
+    Directories found on filesystem and stored in database are compared with
+    these keys, ignoring differences in unicode normalization and trailing
+    separators.
+
+    """
+    if not isinstance(directory, unicode):
+        directory = unicode(directory, 'utf-8')
+    return unicodedata.normalize('NFC', os.path.normpath(directory))
+
+
+def track_key(directory, filename):
+    """Return lookup key for track directory and filename, see album_key"""
+    if not isinstance(filename, unicode):
+        filename = unicode(filename, 'utf-8')
+    return album_key(directory), unicodedata.normalize('NFC', filename)
+
+
+def batches(iterable, size):
+    """Split iterable to lists of given size, consuming it one list at a time"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class TreeUpdater(object):
+
+    """TreeUpdater
+
+    Update albums, tracks and tags of a registered tree to database.
+
+    Existing album and track rows of the tree are preloaded to dictionaries
+    and compared to the filesystem. Changes are written with executemany
+    statements, committing once per batch_size tracks.
+
+    """
+
+    def __init__(self, db, tree, batch_size=DEFAULT_BATCH_SIZE, workers=None):
+        self.log = SoundforestLogger().default_stream
+        self.db = db
+        self.tree = tree
+        self.batch_size = batch_size
+        self.workers = workers is not None and workers or db.sync.threads
+        self.checksum_algorithm = db.get('checksum_algorithm') or DEFAULT_CHECKSUM_ALGORITHM
+        self.checksum_mode = db.get('checksum_mode') or DEFAULT_CHECKSUM_MODE
+        self.jobs = []
+
+        self.db_tree = db.get_tree(tree.path)
+        if self.db_tree is None:
+            raise TreeError('Tree is not registered: %s' % tree.path)
+
+        self.albums = {}
+        self.tracks = {}
+        self.tag_names = {}
+        self.tag_values = {}
+        self.scanned_albums = set()
+        self.checked_albums = set()
+        self.empty_albums = set()
+        self.scanned_tracks = set()
+        self.__reset_batch__()
+
+    def __reset_batch__(self):
+        self.new_tracks = []
+        self.new_tags = {}
+        self.modified_tracks = []
+        self.modified_tags = {}
+        self.modified_paths = {}
+        self.album_mtimes = []
+
+    @property
+    def pending(self):
+        return len(self.new_tracks) + len(self.modified_tracks)
+
+    def load(self, directories=None):
+        """Load existing album and track rows of tree from database
+
+        With directories, only rows of albums in given directories are loaded.
+
+        """
+        albums = models.AlbumModel.__table__
+        tracks = models.TrackModel.__table__
+
+        album_query = select([albums.c.id, albums.c.directory, albums.c.mtime]) \
+            .where(albums.c.tree_id == self.db_tree.id)
+        track_query = select([
+                tracks.c.id, tracks.c.directory, tracks.c.filename, tracks.c.mtime,
+                tracks.c.checksum, tracks.c.checksum_algorithm, tracks.c.checksum_mode
+            ]) \
+            .where(tracks.c.tree_id == self.db_tree.id)
+
+        if directories is None:
+            album_queries = [album_query]
+            track_queries = [track_query]
+        else:
+            directories = list(directories)
+            album_queries = [album_query.where(albums.c.directory.in_(chunk)) for chunk in chunks(directories)]
+            track_queries = [track_query.where(tracks.c.directory.in_(chunk)) for chunk in chunks(directories)]
+
+        self.albums = {}
+        for query in album_queries:
+            for row in self.db.session.execute(query):
+                self.albums[album_key(row.directory)] = {
+                    'id': row.id,
+                    'directory': row.directory,
+                    'mtime': row.mtime,
+                }
+
+        self.tracks = {}
+        for query in track_queries:
+            for row in self.db.session.execute(query):
+                checksum_algorithm, checksum_mode = stored_checksum_type(row.checksum_algorithm, row.checksum_mode)
+                self.tracks[track_key(row.directory, row.filename)] = {
+                    'id': row.id,
+                    'directory': row.directory,
+                    'filename': row.filename,
+                    'mtime': row.mtime,
+                    'checksum': row.checksum,
+                    'checksum_algorithm': checksum_algorithm,
+                    'checksum_mode': checksum_mode,
+                }
+
+    def insert_albums(self, paths):
+        """Insert albums missing from database with one executemany"""
+        albums = models.AlbumModel.__table__
+
+        missing = [path for path in paths if album_key(path) not in self.albums]
+        if not missing:
+            return
+
+        self.db.session.execute(albums.insert(), [
+            {'tree_id': self.db_tree.id, 'directory': path, 'mtime': None}
+            for path in missing
+        ])
+        self.db.commit()
+
+        for chunk in chunks(missing):
+            for row in self.db.session.execute(
+                    select([albums.c.id, albums.c.directory])
+                    .where(albums.c.tree_id == self.db_tree.id)
+                    .where(albums.c.directory.in_(chunk))):
+                self.albums[album_key(row.directory)] = {
+                    'id': row.id,
+                    'directory': row.directory,
+                    'mtime': None,
+                }
+
+    def intern_values(self, table, column, values, cache):
+        """Look up ids of values in tag dictionary table to cache
+
+        Values missing from table are inserted with one executemany.
+
+        """
+        missing = list(set(value for value in values if value not in cache))
+        if not missing:
+            return
+
+        for lookup in (True, False):
+            for chunk in chunks(missing):
+                for row in self.db.session.execute(select([table.c.id, column]).where(column.in_(chunk))):
+                    cache[row[1]] = row[0]
+
+            missing = [value for value in missing if value not in cache]
+            if not missing or not lookup:
+                break
+
+            self.db.session.execute(table.insert(), [{column.name: value} for value in missing])
+
+    def delete_missing(self):
+        """Delete albums and tracks not found by previous update from database
+
+        Album and track rows loaded by update are compared to the album
+        directories and tracks found on filesystem. Tracks of albums skipped
+        by incremental update are kept. Rows whose path still exists are
+        never deleted, even if the scan did not find them, except albums
+        the update found without audio files.
+
+        Returns counters for deleted albums and tracks.
+
+        """
+        session = self.db.session
+        albums = models.AlbumModel.__table__
+        albumarts = models.AlbumArtModel.__table__
+        tracks = models.TrackModel.__table__
+        tags = models.TagModel.__table__
+
+        removed_tracks = []
+        for key, track in self.tracks.items():
+            if key[0] in self.scanned_albums and \
+               (key[0] not in self.checked_albums or key in self.scanned_tracks):
+                continue
+            path = os.path.join(track['directory'], track['filename'])
+            if os.path.exists(path):
+                self.log.debug('Track not found by update, keeping: %s' % path)
+                continue
+            removed_tracks.append(key)
+
+        for keys in chunks(sorted(removed_tracks)):
+            for key in keys:
+                self.log.debug('Removing track: %s' % os.path.join(
+                    self.tracks[key]['directory'], self.tracks[key]['filename']
+                ))
+            ids = [self.tracks.pop(key)['id'] for key in keys]
+            session.execute(tags.delete().where(tags.c.track_id.in_(ids)))
+            session.execute(tracks.delete().where(tracks.c.id.in_(ids)))
+
+        # Albums with remaining tracks are kept
+        track_albums = set(key[0] for key in self.tracks)
+        removed_albums = []
+        for key, album in self.albums.items():
+            if key in self.scanned_albums or key in track_albums:
+                continue
+            if key not in self.empty_albums and os.path.isdir(album['directory']):
+                self.log.debug('Album not found by update, keeping: %s' % album['directory'])
+                continue
+            removed_albums.append(key)
+
+        for keys in chunks(sorted(removed_albums)):
+            for key in keys:
+                self.log.debug('Removing album: %s' % self.albums[key]['directory'])
+            ids = [self.albums.pop(key)['id'] for key in keys]
+            session.execute(albumarts.delete().where(albumarts.c.album_id.in_(ids)))
+            session.execute(albums.delete().where(albums.c.id.in_(ids)))
+
+        self.db.commit()
+        self.db.session.expire_all()
+
+        return len(removed_albums), len(removed_tracks)
+
+    def flush(self):
+        """Write pending batch to database in one transaction"""
+        if not self.pending and not self.album_mtimes:
+            return
+
+        session = self.db.session
+        tracks = models.TrackModel.__table__
+        tags = models.TagModel.__table__
+        search_entries = []
+
+        if self.new_tracks:
+            session.execute(tracks.insert(), self.new_tracks)
+
+            inserted = dict(
+                (track_key(entry['directory'], entry['filename']), entry)
+                for entry in self.new_tracks
+            )
+            directories = list(set(entry['directory'] for entry in self.new_tracks))
+            for batch in chunks(directories):
+                for row in session.execute(
+                        select([tracks.c.id, tracks.c.directory, tracks.c.filename])
+                        .where(tracks.c.tree_id == self.db_tree.id)
+                        .where(tracks.c.directory.in_(batch))):
+                    key = track_key(row.directory, row.filename)
+                    if key not in inserted:
+                        continue
+
+                    self.tracks[key] = {
+                        'id': row.id,
+                        'directory': row.directory,
+                        'filename': row.filename,
+                        'mtime': inserted[key]['mtime'],
+                        'checksum': inserted[key]['checksum'],
+                        'checksum_algorithm': inserted[key]['checksum_algorithm'],
+                        'checksum_mode': inserted[key]['checksum_mode'],
+                    }
+                    if key in self.new_tags:
+                        self.modified_tags[row.id] = self.new_tags.pop(key)
+                        self.modified_paths[row.id] = (row.directory, row.filename)
+                    else:
+                        # Tracks with errors loading tags are found by path
+                        search_entries.append(models.search_index_entry(
+                            row.id,
+                            self.db_tree,
+                            os.path.join(row.directory, row.filename),
+                            []
+                        ))
+
+        if self.modified_tracks:
+            session.execute(
+                tracks.update()
+                .where(tracks.c.id == bindparam('track_id'))
+                .values(
+                    mtime=bindparam('mtime'),
+                    size=bindparam('size'),
+                    checksum=bindparam('checksum'),
+                    checksum_algorithm=bindparam('checksum_algorithm'),
+                    checksum_mode=bindparam('checksum_mode')
+                ),
+                self.modified_tracks
+            )
+
+        if self.modified_tags:
+            track_ids = self.modified_tags.keys()
+            for ids in chunks(track_ids):
+                session.execute(tags.delete().where(tags.c.track_id.in_(ids)))
+
+            tag_names = models.TagNameModel.__table__
+            tag_values = models.TagValueModel.__table__
+            values = [item for items in self.modified_tags.values() for item in items]
+            self.intern_values(tag_names, tag_names.c.name,
+                [tag for tag, value in values],
+                self.tag_names
+            )
+            self.intern_values(tag_values, tag_values.c.value,
+                [value for tag, value in values if tag in models.DICTIONARY_TAGS],
+                self.tag_values
+            )
+
+            rows = []
+            for track_id, values in self.modified_tags.items():
+                for tag, value in values:
+                    if tag in models.DICTIONARY_TAGS:
+                        rows.append({
+                            'track_id': track_id,
+                            'name_id': self.tag_names[tag],
+                            'value': None,
+                            'value_id': self.tag_values[value],
+                        })
+                    else:
+                        rows.append({
+                            'track_id': track_id,
+                            'name_id': self.tag_names[tag],
+                            'value': value,
+                            'value_id': None,
+                        })
+                search_entries.append(models.search_index_entry(
+                    track_id,
+                    self.db_tree,
+                    os.path.join(*self.modified_paths[track_id]),
+                    [value for tag, value in values]
+                ))
+            if rows:
+                session.execute(tags.insert(), rows)
+            session.execute(
+                tracks.update()
+                .where(tracks.c.id == bindparam('track_id'))
+                .values(tag_document=bindparam('tag_document')),
+                [
+                    {'track_id': track_id, 'tag_document': models.tag_document(values)}
+                    for track_id, values in self.modified_tags.items()
+                ]
+            )
+
+        self.db.update_search_index(search_entries)
+
+        if self.album_mtimes:
+            albums = models.AlbumModel.__table__
+            session.execute(
+                albums.update()
+                .where(albums.c.id == bindparam('album_id'))
+                .values(mtime=bindparam('mtime')),
+                self.album_mtimes
+            )
+
+        self.db.commit()
+        self.__reset_batch__()
+
+    def queue_track(self, album_id, track, update_checksum=True):
+        """Check if track needs to be updated
+
+        Track can be a Track or TrackRecord. Returns a job tuple for
+        read_track_info, or None if track is not modified.
+
+        """
+        key = track_key(track.directory, track.filename)
+        existing = self.tracks.get(key, None)
+        mtime = track.mtime
+        self.scanned_tracks.add(key)
+
+        codec_name = track.codec.name
+        checksum_algorithm = update_checksum and self.checksum_algorithm or None
+        checksum_mode = effective_checksum_mode(self.checksum_mode, codec_name)
+
+        if existing is not None and existing['mtime'] == mtime:
+            if checksum_algorithm is None:
+                return None
+            if existing['checksum'] and \
+               existing['checksum_algorithm'] == checksum_algorithm and \
+               existing['checksum_mode'] == checksum_mode:
+                return None
+            read_tags = False
+        else:
+            read_tags = True
+
+        self.jobs.append((
+            (track.directory, track.filename), album_id, track.extension, mtime, track.size, checksum_mode
+        ))
+        return (len(self.jobs) - 1, track.path, codec_name, read_tags, checksum_algorithm, checksum_mode)
+
+    def apply_track_info(self, info):
+        """Queue database changes for track details read by read_track_info
+
+        Returns one of 'added', 'updated' or 'error'.
+
+        """
+        (directory, filename), album_id, extension, mtime, size, checksum_mode = self.jobs[info['job']]
+        key = track_key(directory, filename)
+        existing = self.tracks.get(key, None)
+
+        if info['error'] is not None:
+            self.log.debug('ERROR loading %s: %s' % (info['path'], info['error']))
+            status = 'error'
+            # Tracks with errors are stored without mtime to retry next update
+            mtime = None
+        else:
+            status = existing is None and 'added' or 'updated'
+
+        checksum = info['checksum']
+        if checksum is not None:
+            checksum_algorithm = self.checksum_algorithm
+        else:
+            checksum_algorithm = checksum_mode = None
+        values = info['tags']
+
+        if existing is None:
+            self.new_tracks.append({
+                'tree_id': self.db_tree.id,
+                'album_id': album_id,
+                'directory': directory,
+                'filename': filename,
+                'extension': extension,
+                'mtime': mtime,
+                'size': size,
+                'checksum': checksum,
+                'checksum_algorithm': checksum_algorithm,
+                'checksum_mode': checksum_mode,
+                'deleted': False,
+            })
+            if values is not None:
+                self.new_tags[key] = values
+
+        else:
+            existing['mtime'] = mtime
+            existing['checksum'] = checksum
+            existing['checksum_algorithm'] = checksum_algorithm
+            existing['checksum_mode'] = checksum_mode
+            self.modified_tracks.append({
+                'track_id': existing['id'],
+                'mtime': mtime,
+                'size': size,
+                'checksum': checksum,
+                'checksum_algorithm': checksum_algorithm,
+                'checksum_mode': checksum_mode,
+            })
+            if values is not None:
+                self.modified_tags[existing['id']] = values
+                self.modified_paths[existing['id']] = (directory, filename)
+
+        return status
+
+    def update(self, update_checksum=True, progresslog=False, incremental=False, albums=None):
+        """Update tree albums and tracks to database
+
+        Tags and checksums of modified tracks are read by a pool of worker
+        processes. Results are written to database by this process.
+
+        Albums are read while walking the tree, reusing the directory entries
+        of the walk for track stat information. Missing albums are inserted
+        to database in batches of batch_size albums.
+
+        With albums, only given Album objects are updated instead of all
+        albums in the tree. Albums with missing directories are skipped, and
+        removed by delete_missing.
+
+        Directories without audio files are not stored as albums.
+
+        Returns counters for added, updated, processed and error tracks.
+
+        """
+        added, updated, errors = 0, 0, 0
+        processed = 0
+        skipped = 0
+
+        if update_checksum:
+            # Fail early for unknown or unavailable algorithms and modes
+            new_hash(self.checksum_algorithm)
+            effective_checksum_mode(self.checksum_mode, None)
+
+        if albums is None:
+            self.load()
+            albums = self.tree.iter_albums()
+        else:
+            self.load([album.path for album in albums])
+            albums = [album for album in albums if os.path.isdir(album.path)]
+        self.jobs = []
+        self.scanned_albums = set()
+        self.checked_albums = set()
+        self.empty_albums = set()
+        self.scanned_tracks = set()
+
+        self.log.debug('Checking tree tracks for changes')
+        queue = []
+        album_status = {}
+        for batch in batches(albums, self.batch_size):
+            for album in batch:
+                if not album.entries_loaded:
+                    album.load()
+            self.empty_albums.update(album_key(album.path) for album in batch if not album.files)
+            batch = [album for album in batch if album.files]
+            self.insert_albums([album.path for album in batch])
+
+            for album in batch:
+                self.scanned_albums.add(album_key(album.path))
+                db_album = self.albums[album_key(album.path)]
+                album_mtime = album.mtime
+                if incremental and db_album['mtime'] == album_mtime:
+                    skipped += 1
+                    continue
+
+                status = {
+                    'mtime': album_mtime,
+                    'modified': db_album['mtime'] != album_mtime,
+                    'pending': 0,
+                    'errors': 0,
+                }
+                album_status[db_album['id']] = status
+                self.checked_albums.add(album_key(album.path))
+                for track in album.iter_records():
+                    job = self.queue_track(db_album['id'], track, update_checksum)
+                    processed += 1
+                    if job is not None:
+                        queue.append(job)
+                        status['pending'] += 1
+
+        self.log.debug('Updating %d modified tracks with %d workers' % (len(queue), self.workers))
+        if self.workers > 1 and len(queue) > 1:
+            pool = Pool(processes=self.workers)
+            results = pool.imap_unordered(read_track_info, queue, chunksize=WORKER_CHUNK_SIZE)
+        else:
+            pool = None
+            results = imap(read_track_info, queue)
+
+        try:
+            for count, info in enumerate(results):
+                album_id = self.jobs[info['job']][1]
+                result = self.apply_track_info(info)
+                if result == 'added':
+                    added += 1
+                elif result == 'updated':
+                    updated += 1
+                elif result == 'error':
+                    errors += 1
+                    album_status[album_id]['errors'] += 1
+
+                album_status[album_id]['pending'] -= 1
+
+                if progresslog and (count+1) % 1000 == 0:
+                    self.log.debug('Updated: %d tracks' % (count+1))
+
+                if self.pending >= self.batch_size:
+                    self.flush()
+
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        # Record album mtime only when all tracks were updated, to retry
+        # failed tracks on next incremental update
+        for album_id, status in album_status.items():
+            if not status['modified'] or status['errors'] or status['pending']:
+                continue
+            self.album_mtimes.append({'album_id': album_id, 'mtime': status['mtime']})
+
+        self.flush()
+        self.db.session.expire_all()
+
+        if skipped:
+            self.log.debug('Skipped %d unmodified albums' % skipped)
+
+        return added, updated, processed, errors
@@ -0,0 +1,120 @@
+# coding=utf-8
+"""Directory walker
+
+Directory scanning with scandir, reusing the file type and stat information
+of directory entries instead of checking each path separately.
+
+Uses os.scandir or the scandir module, which is installed as dependency on
+python 2. Without either, os.listdir with cached lstat calls is used: this
+needs one lstat per entry like os.walk.
+
+"""
+
+import os
+
+from stat import S_ISDIR, S_ISREG, S_ISLNK
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class FileEntry(object):
+    """FileEntry
+
+    Directory entry for systems without scandir, with the DirEntry methods
+    used by soundforest. Results of stat calls are cached.
+
+    """
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self.__lstat = None
+        self.__stat = None
+
+    def __repr__(self):
+        return '<FileEntry %s>' % self.name
+
+    def stat(self, follow_symlinks=True):
+        if self.__lstat is None:
+            self.__lstat = os.lstat(self.path)
+
+        if not follow_symlinks:
+            return self.__lstat
+
+        if self.__stat is None:
+            if S_ISLNK(self.__lstat.st_mode):
+                self.__stat = os.stat(self.path)
+            else:
+                self.__stat = self.__lstat
+
+        return self.__stat
+
+    def is_symlink(self):
+        try:
+            return S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+        except OSError:
+            return False
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def scan_directory(path):
+    """Scan directory
+
+    Returns lists of subdirectory and other entries in directory, sorted by
+    name. Raises OSError if directory can't be read.
+
+    """
+    if scandir is not None:
+        entries = list(scandir(path))
+    else:
+        entries = [FileEntry(path, name) for name in os.listdir(path)]
+
+    directories = []
+    files = []
+    for entry in sorted(entries, key=lambda entry: entry.name):
+        if entry.is_dir():
+            directories.append(entry)
+        else:
+            files.append(entry)
+
+    return directories, files
+
+
+def walk(top):
+    """Walk directory tree top down in sorted order
+
+    Yields (path, directories, files) tuples with lists of directory entries.
+    Like with os.walk, entries removed from directories are not walked,
+    symlinks to directories are not followed and unreadable directories are
+    skipped.
+
+    """
+    try:
+        directories, files = scan_directory(top)
+    except OSError:
+        return
+
+    yield top, directories, files
+
+    for entry in directories:
+        if entry.is_symlink():
+            continue
+        for item in walk(entry.path):
+            yield item
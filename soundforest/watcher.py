@@ -0,0 +1,198 @@
+# coding=utf-8
+"""Tree watcher
+
+Watch registered trees for changes with inotify, updating modified albums
+to database in batches with ConfigDB.update_tree.
+
+Requires the pyinotify module.
+
+"""
+
+import os
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from soundforest import SoundforestError
+from soundforest.log import SoundforestLogger
+from soundforest.prefixes import has_prefix
+from soundforest.tree import Tree, Album
+from soundforest.walker import walk
+
+# Seconds without new events before queued albums are updated
+DEFAULT_WATCH_DELAY = 5
+# Maximum seconds to postpone update of queued albums with continuous events
+MAX_WATCH_DELAY = 60
+
+
+class WatcherError(SoundforestError):
+    pass
+
+
+class TreeWatcher(object):
+    """TreeWatcher
+
+    Watch trees with inotify and coalesce events to album directories.
+
+    Queued albums are updated when no new events have been received in
+    delay seconds, or at latest max_delay seconds after the first queued
+    event. If the kernel event queue overflows, whole trees are updated
+    incrementally.
+
+    """
+
+    def __init__(self, db, trees=None, delay=DEFAULT_WATCH_DELAY, max_delay=MAX_WATCH_DELAY):
+        if pyinotify is None:
+            raise WatcherError('Watching trees requires pyinotify module')
+
+        self.log = SoundforestLogger().default_stream
+        self.db = db
+        self.delay = delay
+        self.max_delay = max_delay
+        self.trees = [tree.path for tree in (trees if trees is not None else db.trees)]
+        if not self.trees:
+            raise WatcherError('No trees to watch')
+
+        self.mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+            pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        self.watch_manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.watch_manager, default_proc_fun=self.process_event)
+
+        self.__reset_queue__()
+
+    def __reset_queue__(self):
+        self.directories = {}
+        self.removed = {}
+        self.rescan = set()
+        self.first_event = None
+        self.last_event = None
+
+    @property
+    def pending(self):
+        return bool(self.directories or self.removed or self.rescan)
+
+    def match_tree(self, path):
+        """Return path of watched tree containing path, or None"""
+        matches = [tree for tree in self.trees if has_prefix(path, tree)]
+        if not matches:
+            return None
+        return max(matches, key=len)
+
+    def watch(self, path):
+        """Add recursive watches for path and new directories created in it"""
+        self.log.debug('Watching %s' % path)
+        self.watch_manager.add_watch(path, self.mask, rec=True, auto_add=True, quiet=True)
+
+    def queue_directory(self, tree, directory):
+        self.directories.setdefault(tree, set()).add(directory)
+
+    def queue_subtree(self, tree, path):
+        """Queue album directories in a directory moved or copied to tree"""
+        for (root, dirs, files) in walk(path):
+            if files:
+                self.queue_directory(tree, root)
+
+    def queue_removed(self, tree, path):
+        """Queue directory removed or moved away from tree"""
+        self.removed.setdefault(tree, set()).add(path)
+
+    def process_event(self, event):
+        """Queue album directory of inotify event for updating"""
+        now = time.time()
+        if self.first_event is None:
+            self.first_event = now
+        self.last_event = now
+
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            self.log.debug('inotify event queue overflow, updating all trees')
+            self.rescan.update(self.trees)
+            return
+
+        # IN_IGNORED is sent for removed watched directories whatever the mask
+        if not event.mask & self.mask:
+            return
+
+        tree = self.match_tree(event.pathname)
+        if tree is None:
+            return
+
+        if event.dir:
+            if event.mask & pyinotify.IN_MOVED_TO:
+                # Directories moved from outside the tree have no watches
+                self.watch(event.pathname)
+                self.queue_subtree(tree, event.pathname)
+            elif event.mask & pyinotify.IN_CREATE:
+                self.queue_subtree(tree, event.pathname)
+            elif event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+                self.queue_removed(tree, event.pathname)
+
+        elif event.mask & pyinotify.IN_CREATE:
+            # Files are updated when closed after writing
+            return
+
+        else:
+            self.queue_directory(tree, os.path.dirname(event.pathname))
+
+    def removed_albums(self, tree, paths):
+        """Return album directories of tree in database under removed paths"""
+        db_tree = self.db.get_tree(tree)
+        if db_tree is None:
+            return []
+
+        directories = []
+        for album in db_tree.albums:
+            for path in paths:
+                if has_prefix(album.directory, path):
+                    directories.append(album.directory)
+                    break
+        return directories
+
+    def flush(self):
+        """Update queued albums and trees to database"""
+        rescan, directories, removed = self.rescan, self.directories, self.removed
+        self.__reset_queue__()
+
+        for tree in rescan:
+            self.log.debug('Updating tree %s' % tree)
+            self.db.update_tree(Tree(tree), incremental=True)
+
+        for tree in set(directories.keys()) | set(removed.keys()):
+            if tree in rescan:
+                continue
+
+            paths = directories.get(tree, set())
+            if tree in removed:
+                paths.update(self.removed_albums(tree, removed[tree]))
+
+            self.log.debug('Updating %d albums in %s' % (len(paths), tree))
+            added, updated, deleted, processed, errors, deleted_albums = self.db.update_tree(
+                Tree(tree),
+                albums=[Album(path) for path in sorted(paths)]
+            )
+            self.log.debug('%s: %d added %d updated %d deleted %d albums deleted %d errors' % (
+                tree, added, updated, deleted, deleted_albums, errors
+            ))
+
+    def run(self):
+        """Watch trees and update changes until interrupted"""
+        for tree in self.trees:
+            self.watch(tree)
+
+        try:
+            while True:
+                if self.notifier.check_events(timeout=int(self.delay * 1000)):
+                    self.notifier.read_events()
+                    self.notifier.process_events()
+
+                if not self.pending:
+                    continue
+
+                now = time.time()
+                if now - self.last_event >= self.delay or now - self.first_event >= self.max_delay:
+                    self.flush()
+
+        finally:
+            self.notifier.stop()